@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+import datetime
+import json
+import math
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+from docopt import docopt
+from pymongo import MongoClient
+
+from rapidpro_tools import CONFIG, logger, change_logging_level
+
+help = ("""Usage: benchmark-dump.py [-v] [-h] [-p port] [-n count] """
+        """[-P size] [-l latency] [-e rate] [-t rate] [-m modes] [-o FILE]
+
+-h --help                       Display this help message
+-v --verbose                    Display DEBUG messages
+-p --port=<port>                Port for the API simulator (defaults to 8765)
+-n --count=<nb_items>           Nb of messages, runs and contacts"""
+        """ (defaults to 10000)
+-P --page-size=<nb_items>       Nb of results per page (defaults to 100)
+-l --latency=<ms>               Added latency per API request"""
+        """ (defaults to 0)
+-e --error-rate=<ratio>         Ratio of API requests failing with a 502
+-t --throttle-rate=<ratio>      Ratio of API requests throttled with a 429
+-m --modes=<modes>              Comma separated list of dump modes"""
+        """ (defaults to all)
+-o --output=<path>              Write the benchmark report as JSON
+
+This script runs dump-rapidpro.py against a local API simulator in """
+        """each dump mode and reports its throughput.
+Dumps are written to the `<mongo_database>_benchmark` database. """)
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+ENDPOINTS = ['--contacts', '--relayers', '--messages',
+             '--fields', '--flows', '--runs']
+# simulated items are dated back from that day, runs 2 minutes apart
+SIMULATOR_END_ON = datetime.datetime(2015, 1, 1)
+SIMULATOR_MAX_STEP = 120
+SEGMENTS_DIR = 'segments'
+MODES = OrderedDict([
+    ('sequential', []),
+    ('pipelined', ['--pipeline-depth', '4']),
+    ('concurrent', ['--workers', '6']),
+    ('pipelined-concurrent', ['--pipeline-depth', '4', '--workers', '6']),
+    ('streamed', ['--stream']),
+    ('fanout', ['--fanout', '6']),
+    ('backfill', ['--backfill', '{backfill_from}',
+                  '--backfill-to', '{backfill_to}',
+                  '--window-days', '1', '--window-workers', '4']),
+    ('segments', ['--output-dir', SEGMENTS_DIR]),
+])
+
+
+def mode_params(count):
+    """ values of the MODES args placeholders for count simulated items """
+    days = int(math.ceil(count * SIMULATOR_MAX_STEP / 86400))
+    return {
+        'backfill_from': (SIMULATOR_END_ON - datetime.timedelta(days=days))
+        .strftime('%Y-%m-%d'),
+        'backfill_to': (SIMULATOR_END_ON + datetime.timedelta(days=1))
+        .strftime('%Y-%m-%d'),
+    }
+
+
+def wait_for_port(port, timeout=30):
+    started_on = time.time()
+    while time.time() - started_on < timeout:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return True
+        except socket.error:
+            time.sleep(0.1)
+    return False
+
+
+def start_simulator(port, options):
+    """ starts rapidpro-simulator.py, passing options as CLI options """
+    args = [sys.executable, os.path.join(ROOT, 'rapidpro-simulator.py'),
+            '--port', "{}".format(port)]
+    for option, value in options.items():
+        if value is not None:
+            args += [option, value]
+    logger.debug("Starting simulator: {}".format(" ".join(args)))
+    simulator = subprocess.Popen(args)
+    if not wait_for_port(port):
+        simulator.terminate()
+        raise RuntimeError("API simulator did not start on port {}"
+                           .format(port))
+    return simulator
+
+
+def run_mode(mode, workdir, database, params):
+    """ runs a full dump in mode, returns its measurements """
+    summary_path = os.path.join(workdir, '{}.json'.format(mode))
+    args = [sys.executable, os.path.join(ROOT, 'dump-rapidpro.py'),
+            '--noresume', '--summary', summary_path] \
+        + [arg.format(**params) for arg in MODES[mode]] + ENDPOINTS
+
+    MongoClient(CONFIG.get('mongo_url')).drop_database(database)
+    shutil.rmtree(os.path.join(workdir, SEGMENTS_DIR), ignore_errors=True)
+
+    started_on = time.time()
+    dump = subprocess.Popen(args, cwd=workdir)
+    # wait4 gives us the rusage of that very child
+    __, status, rusage = os.wait4(dump.pid, 0)
+    duration = time.time() - started_on
+    dump.returncode = os.WEXITSTATUS(status) \
+        if os.WIFEXITED(status) else -1
+
+    results = []
+    if dump.returncode != 0:
+        logger.error("{} dump exited with status {}"
+                     .format(mode, dump.returncode))
+    if os.path.exists(summary_path):
+        with open(summary_path, 'r') as f:
+            results = json.load(f)
+
+    def total(key):
+        return sum([result['totals'].get(key, 0) for result in results])
+
+    return OrderedDict([
+        ('mode', mode),
+        ('success', dump.returncode == 0 and bool(results)
+            and all([result['success'] for result in results])),
+        ('duration', duration),
+        ('pages', total('pages')),
+        ('documents', total('documents')),
+        ('pages_per_sec', total('pages') / duration),
+        ('docs_per_sec', total('documents') / duration),
+        # ru_maxrss is in kilobytes on Linux
+        ('peak_rss_mb', rusage.ru_maxrss / 1024),
+        ('write_time', total('write_time')),
+    ])
+
+
+def main(arguments):
+    debug = arguments.get('--verbose') or False
+    change_logging_level(debug)
+
+    port = int(arguments.get('--port') or 8765)
+    params = mode_params(int(arguments.get('--count') or 10000))
+    modes = (arguments.get('--modes') or ",".join(MODES.keys())).split(',')
+    for mode in modes:
+        if mode not in MODES:
+            logger.error("Unknown mode `{}`. Available modes: {}"
+                         .format(mode, ", ".join(MODES.keys())))
+            return 1
+
+    # dumps read config.json from their working directory
+    database = "{}_benchmark".format(CONFIG.get('mongo_database'))
+    workdir = tempfile.mkdtemp(prefix='rapidpro-benchmark-')
+    config = CONFIG.copy()
+    config.update({
+        'server_url': "http://127.0.0.1:{}/api/v1".format(port),
+        'mongo_database': database,
+        'api_token': "benchmark",
+        'rate_limit': 1000,
+        'backoff_factor': 0.1,
+    })
+    with open(os.path.join(workdir, 'config.json'), 'w') as f:
+        json.dump(config, f, indent=4)
+
+    simulator = start_simulator(port, {
+        option: arguments.get(option)
+        for option in ('--count', '--page-size', '--latency',
+                       '--error-rate', '--throttle-rate')})
+    reports = []
+    try:
+        for mode in modes:
+            logger.info("Benchmarking {} dump...".format(mode))
+            reports.append(run_mode(mode, workdir, database, params))
+    finally:
+        simulator.terminate()
+        simulator.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    logger.info("{:<22}{:>10}{:>10}{:>12}{:>12}{:>10}{:>12}".format(
+        "mode", "time (s)", "pages/s", "docs/s",
+        "RSS (MB)", "write (s)", "status"))
+    for report in reports:
+        logger.info("{mode:<22}{duration:>10.1f}{pages_per_sec:>10.1f}"
+                    "{docs_per_sec:>12.1f}{peak_rss_mb:>12.1f}"
+                    "{write_time:>10.1f}{status:>12}"
+                    .format(status="OK" if report['success'] else "FAILED",
+                            **report))
+
+    if arguments.get('--output'):
+        with open(arguments.get('--output'), 'w') as f:
+            json.dump(reports, f, indent=4)
+
+    if not all([report['success'] for report in reports]):
+        logger.error("-- Some dumps failed. :(")
+        return 1
+
+    logger.info("-- All done. :)")
+
+
+if __name__ == '__main__':
+    sys.exit(main(docopt(help, version=0.1)))
@@ -7,11 +7,9 @@ from __future__ import (unicode_literals, absolute_import,
 
 import cherrypy
 from rapidpro_tools import logger
-from rapidpro_tools.mongo import db
+from rapidpro_tools.mongo import numbers
 from rapidpro_mali import clean_number
 
-numbers = db['numbers']
-
 
 class UContactReceiver(object):
     @cherrypy.expose
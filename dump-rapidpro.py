@@ -5,205 +5,725 @@
 from __future__ import (unicode_literals, absolute_import,
                         division, print_function)
 import datetime
+import json
+import math
+import sys
+import threading
+import time
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+try:
+    from queue import Queue, Full
+except ImportError:
+    from Queue import Queue, Full
 
 from docopt import docopt
 
 from rapidpro_tools import logger, change_logging_level
-from rapidpro_tools.mongo import (meta, contacts, relayers, messages, runs,
-                                  flows, fields)
-from rapidpro_tools.utils import get_api_data
-
-help = ("""Usage: dump-rapidpro.py [-v] [-h] [-z] [-a after] [--messages] """
-        """[--contacts] [--relayers] [--fields] [--flows] [--runs]
+from rapidpro_tools.mongo import (db, meta, contacts, relayers, messages,
+                                  runs, flows, fields, ensure_indexes)
+from rapidpro_tools.metrics import get_metrics, write_prometheus
+from rapidpro_tools.segments import (SegmentWriter, read_manifest,
+                                     iter_segment_pages, SEGMENT_SIZE)
+from rapidpro_tools.utils import (get_api_data, stream_api_data,
+                                  close_results, APIError,
+                                  content_hash, datetime_to_iso,
+                                  datetime_from_iso,
+                                  CONTENT_HASH_FIELD, WRITTEN_ON_FIELD,
+                                  RATE_LIMIT)
+
+help = ("""Usage: dump-rapidpro.py [-v] [-h] [-z] [-r] [-a after] """
+        """[-p depth] [-w workers] [-s path] [-m path] [-S [-b size]] """
+        """[-f workers] [-B date [-T date] [-d days] [-W workers]] """
+        """[-o dir [-g size]] [-R dir] [--messages] [--contacts] """
+        """[--relayers] [--fields] [--flows] [--runs]
 
 -h --help                       Display this help message
 -v --verbose                    Display DEBUG messages
 -a --after=<datetime_str>       rapidpro datetime formatted string.
--z --noresume                   Do NOT download where it left (messages)
-
---relayers                      Dumps all relayers
---contacts                      Dumps all contacts
+-z --noresume                   Do NOT download where it left
+-r --resume                     Continue interrupted dumps from the last
+                                written page
+-p --pipeline-depth=<nb_pages>  Fetch up to <nb_pages> pages ahead while
+                                writing to mongo (0 disables pipelining)
+-w --workers=<nb_workers>       Dump up to <nb_workers> endpoints
+                                concurrently (defaults to 1)
+-s --summary=<path>             Write the per-endpoint summary and metrics
+                                as JSON
+-m --metrics=<path>             Write the per-endpoint metrics as a
+                                prometheus text file
+-S --stream                     Decode API pages incrementally and write
+                                them in batches (no pipelining)
+-b --batch-size=<nb_items>      Nb of items per mongo write when streaming
+                                (defaults to 100)
+-f --fanout=<nb_workers>        Fetch messages and runs in time windows
+                                with <nb_workers> concurrent requests
+                                (no checkpoints)
+-B --backfill=<date>            Dump messages and runs from <date> in time
+                                windows fetched in parallel (YYYY-MM-DD)
+-T --backfill-to=<date>         End of backfill (defaults to now)
+-d --window-days=<nb_days>      Nb of days per backfill window"""
+        """ (defaults to 7)
+-W --window-workers=<nb>        Nb of windows fetched concurrently"""
+        """ (defaults to 4)
+-o --output-dir=<dir>           Write to gzipped NDJSON segment files in
+                                <dir> instead of mongo
+-g --segment-size=<nb_items>    Nb of items per segment file"""
+        """ (defaults to 100000)
+-R --replay=<dir>               Load segment files written with"""
+        """ --output-dir
+                                into mongo instead of calling the API
+
+--relayers                      Dumps all relayers (modified since last dump)
+--contacts                      Dumps all contacts (modified since last dump)
 --messages                      Dumps all messages
 --flows                         Dumps all flows
 --fields                        Dumps all fields
 --runs                          Dumps all runs
 
-This script dumps JSON data from a rapidpro instance into mongo """)
+API requests are throttled to `rate_limit` requests per second and per
+host (config.json, defaults to 5). Raise it along with --workers, --fanout
+or --window-workers or the extra concurrency will only wait on it.
 
+This script dumps JSON data from a rapidpro instance into mongo """
+        """(or segment files) """)
+
+END_OF_PAGES = object()
+FANOUT_MAX_ROUNDS = 5
+FANOUT_WINDOWS_PER_WORKER = 4
+FANOUT_OVERLAP = datetime.timedelta(seconds=1)
+# endpoints listed newest first on the field their after/before filter on
+FANOUT_DATE_FIELDS = {
+    'messages': 'created_on',
+    'runs': 'modified_on',
+}
+REPLAY_PAGE_SIZE = 1000
+
+
+_segment_writers = {}
+_segment_writers_lock = threading.Lock()
+
+
+def segment_writer(endpoint, **options):
+    """ SegmentWriter of endpoint when dumping to --output-dir """
+    with _segment_writers_lock:
+        if endpoint not in _segment_writers:
+            _segment_writers[endpoint] = SegmentWriter(
+                options.get('output_dir'), endpoint,
+                segment_size=options.get('segment_size'))
+    return _segment_writers[endpoint]
 
-def update_meta(endpoint, updated_on):
-    db_item = meta.find_one({'endpoint': endpoint})
-    if db_item:
-        db_item.update({'updated_on': updated_on})
-        meta.save(db_item)
-    else:
-        meta.insert({'endpoint': endpoint,
-                     'updated_on': updated_on})
 
+def read_meta(endpoint, **options):
+    if options.get('output_dir'):
+        return segment_writer(endpoint, **options).meta
+    return meta.find_one({'endpoint': endpoint}) or {}
 
-def update_collection(collection, data, id_field='uuid'):
-    if not data['count']:
+
+def write_meta(endpoint, updates, **options):
+    """ sets endpoint meta fields (dotted for nested), None unsets them """
+    if options.get('output_dir'):
+        segment_writer(endpoint, **options).update_meta(updates)
         return
+    changes = {}
+    sets = {key: value for key, value in updates.items() if value is not None}
+    unsets = {key: '' for key, value in updates.items() if value is None}
+    if sets:
+        changes['$set'] = sets
+    if unsets:
+        changes['$unset'] = unsets
+    meta.update({'endpoint': endpoint}, changes, upsert=True)
+
+
+def update_meta(endpoint, updated_on, **options):
+    # endpoint completed, no need to resume from there anymore
+    write_meta(endpoint, {'updated_on': updated_on, 'checkpoint': None},
+               **options)
+
+
+def get_checkpoint(endpoint, **options):
+    return read_meta(endpoint, **options).get('checkpoint')
+
+
+def save_checkpoint(endpoint, next_url, **options):
+    """ records the next page to fetch once a page has been written """
+    write_meta(endpoint, {'checkpoint': {
+        'next': next_url, 'started_on': options.get('started_on')}},
+        **options)
+
+
+def nb_stored(collection, **options):
+    if options.get('output_dir'):
+        return segment_writer(collection.name, **options).nb_documents
+    return collection.count()
+
+
+def write_batch(collection, items, id_field, report):
+    """ upserts items whose content hash changed in an unordered bulk op """
+    stored = {
+        doc.get(id_field): doc.get(CONTENT_HASH_FIELD)
+        for doc in collection.find(
+            {id_field: {'$in': [item.get(id_field) for item in items]}},
+            {id_field: True, CONTENT_HASH_FIELD: True})}
+
+    bulk = None
+    written_on = datetime_to_iso(datetime.datetime.utcnow())
+    for item in items:
+        digest = content_hash(item)
+        if stored.get(item.get(id_field)) == digest:
+            report['unchanged'] += 1
+            continue
+        if bulk is None:
+            bulk = collection.initialize_unordered_bulk_op()
+        item[CONTENT_HASH_FIELD] = digest
+        item[WRITTEN_ON_FIELD] = written_on
+        bulk.find({id_field: item.get(id_field)}) \
+            .upsert().update_one({'$set': item})
+
+    if bulk is not None:
+        result = bulk.execute()
+        report['inserted'] += result.get('nUpserted', 0)
+        report['updated'] += result.get('nMatched', 0)
+
+
+def after_params(endpoint, **options):
+    """ API filter for items modified since --after or last dump """
+    if options.get('after'):
+        return {'after': options.get('after')}
+    if options.get('resume'):
+        updated_on = read_meta(endpoint, **options).get('updated_on')
+        if updated_on is not None:
+            return {'after': updated_on}
+    return {}
+
+
+def update_collection(collection, data, id_field='uuid', batch_size=None):
+    """ writes a page of API results, skipping unchanged items
+
+        the whole page is sent at once unless batch_size is set.
+        returns a dict of inserted, updated and unchanged counts """
+    report = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'documents': 0}
+    if not data['count'] or not data['results']:
+        return report
+
+    batch = []
     for item in data['results']:
-        if collection.find({id_field: item.get(id_field)}).count():
-            # item exist. update?
-            db_item = collection.find_one(
-                {id_field: item.get(id_field)})
-            db_item.update(item)
-            collection.save(db_item)
+        batch.append(item)
+        report['documents'] += 1
+        if batch_size and len(batch) >= batch_size:
+            write_batch(collection, batch, id_field, report)
+            batch = []
+    if batch:
+        write_batch(collection, batch, id_field, report)
+
+    logger.info("{ns}: {inserted} inserted, {updated} updated, "
+                "{unchanged} unchanged."
+                .format(ns=collection.name, **report))
+    return report
+
+
+def iter_pages(url_or_path, stream=False, **params):
+    """ yields each API page, following `next` links
+
+        streamed pages must have their results consumed before
+        the next page is requested. """
+    get_page = stream_api_data if stream else get_api_data
+    page = get_page(url_or_path, **params)
+    yield page
+    while page.get('next'):
+        page = get_page(page.get('next'))
+        yield page
+
+
+def pages_for(collection, url_or_path, params=None, **options):
+    """ API pages for collection, from its checkpoint if resuming """
+    if options.get('fanout'):
+        date_field = FANOUT_DATE_FIELDS.get(collection.name)
+        if date_field is not None:
+            return fanout_pages(url_or_path, options.get('fanout'),
+                                date_field, params)
+        logger.info("{} can not be fanned out. Following its pages."
+                    .format(collection.name))
+    checkpoint = get_checkpoint(collection.name, **options) \
+        if options.get('from_checkpoint') else None
+    if checkpoint:
+        logger.info("Resuming {} from {}"
+                    .format(collection.name, checkpoint['next']))
+        return iter_pages(checkpoint['next'], stream=options.get('stream'))
+    return iter_pages(url_or_path, stream=options.get('stream'),
+                      **(params or {}))
+
+
+def put_until(pipe, stop, entry):
+    """ puts entry in a bounded queue, False if stop was set meanwhile """
+    while not stop.is_set():
+        try:
+            pipe.put(entry, timeout=1)
+            return True
+        except Full:
+            continue
+    return False
+
+
+def fetch_window(url_or_path, params, emit):
+    """ passes every page of a time window to emit, until consistent
+
+        items never enter a past window (they are only added at the
+        newest end) but leave it when deleted, shifting the following
+        ones across pages. A pass during which the window count did not
+        change has thus seen all of it. Other passes are fetched again,
+        the pages seen twice being upserted on their id field. """
+    page = get_api_data(url_or_path, **params)
+    for round_number in range(FANOUT_MAX_ROUNDS):
+        count = page['count']
+        received = 0
+        try:
+            while True:
+                if not emit(page):
+                    return
+                received += len(page['results'])
+                if not page.get('next'):
+                    break
+                page = get_api_data(page.get('next'))
+        except APIError as e:
+            if e.status_code != 404:
+                raise
+            # page vanished as items were removed meanwhile
+        page = get_api_data(url_or_path, **params)
+        if page['count'] == count and received == count:
+            return
+        logger.warning("{} items between {} and {} changed while fetching "
+                       "them. Fetching them again."
+                       .format(url_or_path, params['after'],
+                               params['before']))
+    raise RuntimeError("{} items between {} and {} kept changing for {} "
+                       "rounds.".format(url_or_path, params['after'],
+                                        params['before'], FANOUT_MAX_ROUNDS))
+
+
+def fanout_pages(url_or_path, workers, date_field, params=None):
+    """ yields API pages of time windows fetched concurrently
+
+        page numbers are not stable while items are removed, so the
+        listing (newest first on date_field, the field `after` and
+        `before` filter on) is split in time windows instead, each one
+        following its `next` links until fetched consistently
+        (see fetch_window). """
+    params = params or {}
+    first = get_api_data(url_or_path, **params)
+    page_size = len(first['results'])
+    if not first.get('next') or not page_size:
+        yield first
+        return
+
+    nb_pages = int(math.ceil(first['count'] / page_size))
+    try:
+        last = get_api_data(url_or_path, page=nb_pages, **params)
+    except APIError as e:
+        if e.status_code != 404:
+            raise
+        last = None
+    if not (last and last['results']):
+        logger.warning("Last page of {} vanished. Following its pages."
+                       .format(url_or_path))
+        for page in iter_pages(url_or_path, **params):
+            yield page
+        return
+
+    # bounds are padded as the API filters could be exclusive
+    after = datetime_from_iso(params.get('after')
+                              or last['results'][-1][date_field]) \
+        - FANOUT_OVERLAP
+    before = datetime_from_iso(params.get('before')
+                               or first['results'][0][date_field])
+    nb_windows = min(nb_pages, workers * FANOUT_WINDOWS_PER_WORKER)
+    before += FANOUT_OVERLAP
+    windows = time_windows(after, before, (before - after).total_seconds()
+                           / nb_windows / 86400)
+    logger.info("Fetching {} in {} time windows."
+                .format(url_or_path, len(windows)))
+
+    pipe = Queue(maxsize=workers * 2)
+    stop = threading.Event()
+
+    def run(window):
+        window_params = dict(params)
+        window_params.update({
+            'after': datetime_to_iso(window[0]),
+            'before': datetime_to_iso(window[1] + FANOUT_OVERLAP)})
+        try:
+            fetch_window(url_or_path, window_params,
+                         lambda page: put_until(pipe, stop, (page, None)))
+        except Exception as e:
+            put_until(pipe, stop, (None, e))
+
+    pool = ThreadPool(workers)
+    pool.map_async(run, windows, chunksize=1,
+                   callback=lambda __: put_until(pipe, stop,
+                                                 (END_OF_PAGES, None)))
+    try:
+        while True:
+            page, exc = pipe.get()
+            if exc is not None:
+                raise exc
+            if page is END_OF_PAGES:
+                break
+            yield page
+    finally:
+        stop.set()
+        pool.terminate()
+        pool.join()
+
+
+def pipelined(pages, depth):
+    """ fetches pages in a background thread, at most `depth` ahead
+
+        pages are handed over through a bounded queue so that fetching
+        the next page overlaps with writing the current one """
+    pipe = Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(entry):
+        return put_until(pipe, stop, entry)
+
+    def fetch():
+        try:
+            for page in pages:
+                if not put((page, None)):
+                    return
+        except Exception as e:
+            put((None, e))
         else:
-            collection.insert(item)
-    return
+            put((END_OF_PAGES, None))
+
+    fetcher = threading.Thread(target=fetch)
+    fetcher.daemon = True
+    fetcher.start()
+    try:
+        while True:
+            page, exc = pipe.get()
+            if exc is not None:
+                raise exc
+            if page is END_OF_PAGES:
+                break
+            yield page
+    finally:
+        stop.set()
+        fetcher.join()
+
+
+def write_pages(collection, pages, id_field, **options):
+    """ writes all pages to collection, returns summed per-page reports """
+    totals = {'inserted': 0, 'updated': 0, 'unchanged': 0,
+              'pages': 0, 'documents': 0, 'write_time': 0}
+    if options.get('pipeline_depth'):
+        pages = pipelined(pages, options.get('pipeline_depth'))
+    try:
+        for page in pages:
+            started_on = time.time()
+            try:
+                if options.get('output_dir'):
+                    report = segment_writer(collection.name, **options) \
+                        .write_page(page, id_field)
+                else:
+                    report = update_collection(
+                        collection=collection, data=page, id_field=id_field,
+                        batch_size=options.get('batch_size'))
+            finally:
+                # empty or failed streamed pages are not fully read
+                close_results(page)
+            totals['write_time'] += time.time() - started_on
+            totals['pages'] += 1
+            for key, value in report.items():
+                totals[key] += value
+            if page.get('next') and options.get('checkpoint'):
+                save_checkpoint(collection.name, page.get('next'), **options)
+    finally:
+        if hasattr(pages, 'close'):
+            pages.close()
+    logger.info("{ns} total: {inserted} inserted, {updated} updated, "
+                "{unchanged} unchanged."
+                .format(ns=collection.name, **totals))
+    return totals
+
+
+def time_windows(start_on, end_on, days):
+    """ consecutive [after, before] windows of `days` days """
+    windows = []
+    after = start_on
+    while after < end_on:
+        before = min(end_on, after + datetime.timedelta(days=days))
+        windows.append((after, before))
+        after = before
+    return windows
+
+
+def window_key(window):
+    return "_".join([adate.strftime('%Y%m%dT%H%M%S') for adate in window])
+
+
+def backfill(collection, url_or_path, id_field, **options):
+    """ dumps collection window by window, in parallel
+
+        completed windows are recorded in meta and skipped next time
+        so a failed backfill can be run again for its failed windows. """
+    endpoint = collection.name
+    windows = time_windows(options.get('backfill_from'),
+                           options.get('backfill_to'),
+                           options.get('window_days'))
+    done = [key for key, status in
+            (read_meta(endpoint, **options).get('backfill') or {}).items()
+            if status == 'done']
+    todo = [window for window in windows if window_key(window) not in done]
+    logger.info("Backfilling {}: {} windows, {} already completed."
+                .format(endpoint, len(windows), len(windows) - len(todo)))
+
+    window_options = options.copy()
+    window_options.update({'from_checkpoint': False, 'checkpoint': False})
+
+    def dump_window(window):
+        params = {'after': datetime_to_iso(window[0]),
+                  'before': datetime_to_iso(window[1])}
+        try:
+            totals = write_pages(collection=collection,
+                                 pages=pages_for(collection, url_or_path,
+                                                 params, **window_options),
+                                 id_field=id_field, **window_options)
+        except Exception as e:
+            logger.error("Failed to backfill {} window {}."
+                         .format(endpoint, window_key(window)))
+            logger.exception(e)
+            status, totals = 'failed', {}
+        else:
+            status = 'done'
+        write_meta(endpoint, {'backfill.{}'.format(window_key(window)):
+                              status}, **options)
+        return status, totals
+
+    pool = ThreadPool(options.get('window_workers'))
+    try:
+        results = pool.map(dump_window, todo)
+    finally:
+        pool.close()
+        pool.join()
+
+    totals = {}
+    for status, window_totals in results:
+        for key, value in window_totals.items():
+            totals[key] = totals.get(key, 0) + value
+
+    failed = len([status for status, __ in results if status != 'done'])
+    if failed:
+        raise RuntimeError("{} {} windows failed. Run again to retry them."
+                           .format(failed, endpoint))
+    return totals
 
 
 def dump_contacts(**options):
     logger.info("Updating Contacts. Currently have {} contacts in DB."
-                .format(contacts.count()))
+                .format(nb_stored(contacts, **options)))
 
-    # call contacts API
-    contacts_list = get_api_data('/contacts.json')
-    update_collection(collection=contacts,
-                      data=contacts_list,
-                      id_field='uuid')
+    params = after_params('contacts', **options)
 
-    # loop through potential next pages
-    while contacts_list.get('next'):
-        contacts_list = get_api_data(contacts_list.get('next'))
-        update_collection(collection=contacts,
-                          data=contacts_list,
-                          id_field='uuid')
+    totals = write_pages(collection=contacts,
+                         pages=pages_for(contacts, '/contacts.json',
+                                         params, **options),
+                         id_field='uuid', **options)
 
     logger.info("Updated Contacts completed. Now have {} contacts in DB."
-                .format(contacts.count()))
+                .format(nb_stored(contacts, **options)))
+
+    return totals
 
 
 def dump_relayers(**options):
     logger.info("Updating Relayers. Currently have {} relayers in DB."
-                .format(relayers.count()))
+                .format(nb_stored(relayers, **options)))
 
-    # call relayers API
-    relayers_list = get_api_data('/relayers.json')
-    update_collection(collection=relayers,
-                      data=relayers_list,
-                      id_field='relayer')
+    params = after_params('relayers', **options)
 
-    # loop through potential next pages
-    while relayers_list.get('next'):
-        relayers_list = get_api_data(relayers_list.get('next'))
-        update_collection(collection=relayers,
-                          data=relayers_list,
-                          id_field='relayer')
+    totals = write_pages(collection=relayers,
+                         pages=pages_for(relayers, '/relayers.json',
+                                         params, **options),
+                         id_field='relayer', **options)
 
     logger.info("Updated Relayers completed. Now have {} relayers in DB."
-                .format(relayers.count()))
+                .format(nb_stored(relayers, **options)))
+
+    return totals
 
 
 def dump_messages(**options):
     logger.info("Updating Messages. Currently have {} messages in DB."
-                .format(messages.count()))
+                .format(nb_stored(messages, **options)))
 
-    params = {}
-    if options.get('after'):
-        params.update({'after': options.get('after')})
-    elif options.get('resume'):
-        if meta.find_one({'endpoint': 'messages'}) is not None:
-            params.update({
-                'after': meta.find_one({
-                    'endpoint': 'messages'}).get('updated_on')})
-
-    # call messages API
-    messages_list = get_api_data('/messages.json', **params)
-    update_collection(collection=messages,
-                      data=messages_list,
-                      id_field='id')
-
-    # loop through potential next pages
-    while messages_list.get('next'):
-        messages_list = get_api_data(messages_list.get('next'))
-        update_collection(collection=messages,
-                          data=messages_list,
-                          id_field='id')
+    if options.get('backfill_from'):
+        totals = backfill(collection=messages, url_or_path='/messages.json',
+                          id_field='id', **options)
+    else:
+        params = after_params('messages', **options)
+        totals = write_pages(collection=messages,
+                             pages=pages_for(messages, '/messages.json',
+                                             params, **options),
+                             id_field='id', **options)
 
     logger.info("Updated Messages completed. Now have {} messages in DB."
-                .format(messages.count()))
+                .format(nb_stored(messages, **options)))
+
+    return totals
 
 
 def dump_fields(**options):
     logger.info("Updating Fields. Currently have {} fields in DB."
-                .format(fields.count()))
+                .format(nb_stored(fields, **options)))
 
-    # call fields API
-    fields_list = get_api_data('/fields.json')
-    update_collection(collection=fields,
-                      data=fields_list,
-                      id_field='key')
-
-    # loop through potential next pages
-    while fields_list.get('next'):
-        fields_list = get_api_data(fields_list.get('next'))
-        update_collection(collection=fields,
-                          data=fields_list,
-                          id_field='key')
+    totals = write_pages(collection=fields,
+                         pages=pages_for(fields, '/fields.json',
+                                         **options),
+                         id_field='key', **options)
 
     logger.info("Updated Fields completed. Now have {} fields in DB."
-                .format(fields.count()))
+                .format(nb_stored(fields, **options)))
+
+    return totals
 
 
 def dump_flows(**options):
     logger.info("Updating Flows. Currently have {} flows in DB."
-                .format(flows.count()))
+                .format(nb_stored(flows, **options)))
 
-    params = {}
-    if options.get('after'):
-        params.update({'after': options.get('after')})
-    elif options.get('resume'):
-        if meta.find_one({'endpoint': 'flows'}) is not None:
-            params.update({
-                'after': meta.find_one({
-                    'endpoint': 'flows'}).get('updated_on')})
-
-    # call flows API
-    flows_list = get_api_data('/flows.json', **params)
-    update_collection(collection=flows,
-                      data=flows_list,
-                      id_field='uuid')
-
-    # loop through potential next pages
-    while flows_list.get('next'):
-        flows_list = get_api_data(flows_list.get('next'))
-        update_collection(collection=flows,
-                          data=flows_list,
-                          id_field='uuid')
+    params = after_params('flows', **options)
+
+    totals = write_pages(collection=flows,
+                         pages=pages_for(flows, '/flows.json',
+                                         params, **options),
+                         id_field='uuid', **options)
+
+    logger.info("Updated Flows completed. Now have {} flows in DB."
+                .format(nb_stored(flows, **options)))
+
+    return totals
 
 
 def dump_runs(**options):
     logger.info("Updating Runs. Currently have {} runs in DB."
-                .format(runs.count()))
+                .format(nb_stored(runs, **options)))
 
-    params = {}
-    if options.get('after'):
-        params.update({'after': options.get('after')})
-    elif options.get('resume'):
-        if meta.find_one({'endpoint': 'runs'}) is not None:
-            params.update({
-                'after': meta.find_one({
-                    'endpoint': 'runs'}).get('updated_on')})
-
-    # call runs API
-    runs_list = get_api_data('/runs.json', **params)
-    update_collection(collection=runs,
-                      data=runs_list,
-                      id_field='run')
-
-    # loop through potential next pages
-    while runs_list.get('next'):
-        runs_list = get_api_data(runs_list.get('next'))
-        update_collection(collection=runs,
-                          data=runs_list,
-                          id_field='run')
+    if options.get('backfill_from'):
+        totals = backfill(collection=runs, url_or_path='/runs.json',
+                          id_field='run', **options)
+    else:
+        params = after_params('runs', **options)
+        totals = write_pages(collection=runs,
+                             pages=pages_for(runs, '/runs.json',
+                                             params, **options),
+                             id_field='run', **options)
 
     logger.info("Updated Runs completed. Now have {} runs in DB."
-                .format(runs.count()))
+                .format(nb_stored(runs, **options)))
+
+    return totals
+
+
+DUMPS = OrderedDict([
+    ('contacts', dump_contacts),
+    ('relayers', dump_relayers),
+    ('messages', dump_messages),
+    ('fields', dump_fields),
+    ('flows', dump_flows),
+    ('runs', dump_runs),
+])
+
+
+BACKFILLS = ['messages', 'runs']
+
+
+def replay_endpoint(endpoint, **options):
+    """ bulk loads endpoint segments from --replay dir into mongo
+
+        returns totals and the watermark of the dump which wrote them """
+    manifest = read_manifest(options.get('replay_dir'), endpoint)
+    if manifest is None:
+        raise IOError("No {} segments in {}"
+                      .format(endpoint, options.get('replay_dir')))
+
+    logger.info("Replaying {} {} documents from {} segments."
+                .format(sum([segment['documents']
+                             for segment in manifest['segments']]),
+                        endpoint, len(manifest['segments'])))
+    totals = write_pages(collection=db[endpoint],
+                         pages=iter_segment_pages(options.get('replay_dir'),
+                                                  endpoint,
+                                                  REPLAY_PAGE_SIZE),
+                         id_field=manifest['id_field'], **options)
+    return totals, manifest['meta'].get('updated_on')
+
+
+def run_dump(endpoint, now_str, **options):
+    """ dumps a single endpoint, updating its meta only on success """
+    result = {'endpoint': endpoint, 'success': False, 'totals': {}}
+    started_on = time.time()
+
+    # a resumed dump is only as recent as the run which started it
+    checkpoint = get_checkpoint(endpoint, **options) \
+        if options.get('from_checkpoint') else None
+    if checkpoint:
+        now_str = checkpoint.get('started_on') or now_str
+    options.update({'started_on': now_str})
+
+    try:
+        if options.get('replay_dir'):
+            result['totals'], now_str = replay_endpoint(endpoint, **options)
+        else:
+            result['totals'] = DUMPS[endpoint](**options) or {}
+    except Exception as e:
+        logger.error("Failed to dump {}.".format(endpoint))
+        logger.exception(e)
+    else:
+        # a backfill up to a past date says nothing of what came after
+        if now_str and not (endpoint in BACKFILLS
+                            and options.get('backfill_from')
+                            and not options.get('backfill_up_to_now')):
+            update_meta(endpoint, now_str, **options)
+        result['success'] = True
+    finally:
+        if options.get('output_dir'):
+            segment_writer(endpoint, **options).close()
+    result['duration'] = time.time() - started_on
+    result['metrics'] = get_metrics(endpoint).as_dict()
+    return result
+
+
+def log_summary(results):
+    logger.info("-- Summary")
+    for result in results:
+        totals = result['totals']
+        logger.info("{endpoint}: {status} in {duration:.1f}s. "
+                    "{inserted} inserted, {updated} updated, "
+                    "{unchanged} unchanged."
+                    .format(endpoint=result['endpoint'],
+                            status="OK" if result['success'] else "FAILED",
+                            duration=result['duration'],
+                            inserted=totals.get('inserted', 0),
+                            updated=totals.get('updated', 0),
+                            unchanged=totals.get('unchanged', 0)))
+        metrics = result.get('metrics', {})
+        latency = metrics.get('latency', {})
+        bounds = {key: "{}s".format(latency[key])
+                  if latency.get(key) is not None else "?"
+                  for key in ('p50', 'p95')}
+        logger.info("    {pages} pages, {documents} documents, {kb:.0f} KB. "
+                    "latency p50 <= {p50}, p95 <= {p95}. "
+                    "decode {decode:.1f}s, write {write:.1f}s. "
+                    "{retries} retries, {throttles} throttled."
+                    .format(pages=totals.get('pages', 0),
+                            documents=totals.get('documents', 0),
+                            kb=metrics.get('bytes', 0) / 1024,
+                            p50=bounds['p50'], p95=bounds['p95'],
+                            decode=metrics.get('decode_time', 0),
+                            write=totals.get('write_time', 0),
+                            retries=metrics.get('retries', 0),
+                            throttles=metrics.get('throttles', 0)))
 
 
 def main(arguments):
@@ -216,52 +736,105 @@ def main(arguments):
     # endpoints
     options = {
         'after': arguments.get('--after') or None,
-        'resume': not (arguments.get('--noresume') or False)
+        'resume': not (arguments.get('--noresume') or False),
+        'pipeline_depth': int(arguments.get('--pipeline-depth') or 0),
+        'from_checkpoint': arguments.get('--resume') or False,
+        'stream': arguments.get('--stream') or False,
+        'batch_size': int(arguments.get('--batch-size') or 100),
+        'fanout': int(arguments.get('--fanout') or 0),
+        'backfill_from': None,
+        'backfill_to': None,
+        'backfill_up_to_now': False,
+        'window_days': int(arguments.get('--window-days') or 7),
+        'window_workers': int(arguments.get('--window-workers') or 4),
+        'output_dir': arguments.get('--output-dir') or None,
+        'segment_size': int(arguments.get('--segment-size')
+                            or SEGMENT_SIZE),
+        'replay_dir': arguments.get('--replay') or None,
     }
-    do_contacts = arguments.get('--contacts', False)
-    do_messages = arguments.get('--messages', False)
-    do_relayers = arguments.get('--relayers', False)
-    do_fields = arguments.get('--fields', False)
-    do_flows = arguments.get('--flows', False)
-    do_runs = arguments.get('--runs', False)
-
-    if not (do_contacts or do_messages or do_relayers
-            or do_fields or do_flows or do_runs):
+    options['checkpoint'] = not (options['fanout'] or options['replay_dir'])
+    workers = int(arguments.get('--workers') or 1)
+    endpoints = [endpoint for endpoint in DUMPS.keys()
+                 if arguments.get('--{}'.format(endpoint), False)]
+
+    if not endpoints:
         logger.error("You need to specify at least one action")
         return 1
 
-    if debug:
-        logger.debug("Options: {}".format(options))
+    if options['stream'] and options['pipeline_depth']:
+        logger.error("Streamed pages can not be pipelined")
+        return 1
+
+    if options['stream'] and options['fanout']:
+        logger.error("Streamed pages can not be fanned out")
+        return 1
+
+    if options['fanout'] and options['from_checkpoint']:
+        logger.error("Fanned out dumps have no checkpoint to resume from")
+        return 1
+
+    if options['replay_dir'] and options['output_dir']:
+        logger.error("Segments can only be replayed into mongo")
+        return 1
+
+    if not options['stream']:
+        options['batch_size'] = None
 
     now = datetime.datetime.now()
     now_str = now.isoformat()[:-3]
 
-    if do_contacts:
-        dump_contacts(**options)
-        update_meta('contacts', now_str)
+    if arguments.get('--backfill'):
+        try:
+            options['backfill_from'] = datetime.datetime.strptime(
+                arguments.get('--backfill'), '%Y-%m-%d')
+            if arguments.get('--backfill-to'):
+                options['backfill_to'] = datetime.datetime.strptime(
+                    arguments.get('--backfill-to'), '%Y-%m-%d')
+        except ValueError:
+            logger.error("Backfill dates must be YYYY-MM-DD formatted")
+            return 1
+        if options['backfill_to'] is None:
+            options['backfill_to'] = now
+            options['backfill_up_to_now'] = True
 
-    if do_relayers:
-        dump_relayers(**options)
-        update_meta('relayers', now_str)
-
-    if do_messages:
-        dump_messages(**options)
-        update_meta('messages', now_str)
+    if debug:
+        logger.debug("Options: {}".format(options))
 
-    if do_fields:
-        dump_fields(**options)
-        update_meta('fields', now_str)
+    if workers > 1 or options['fanout'] or options['backfill_from']:
+        logger.info("API requests are limited to {} req/s (rate_limit)"
+                    .format(RATE_LIMIT))
+
+    if not options['output_dir']:
+        ensure_indexes()
+
+    def run(endpoint):
+        return run_dump(endpoint, now_str, **options)
+
+    if workers > 1:
+        logger.info("Dumping {} with {} workers"
+                    .format(", ".join(endpoints), workers))
+        pool = ThreadPool(min(workers, len(endpoints)))
+        try:
+            results = pool.map(run, endpoints)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [run(endpoint) for endpoint in endpoints]
 
-    if do_flows:
-        dump_flows(**options)
-        update_meta('flows', now_str)
+    log_summary(results)
+    if arguments.get('--summary'):
+        with open(arguments.get('--summary'), 'w') as f:
+            json.dump(results, f, indent=4)
+    if arguments.get('--metrics'):
+        write_prometheus(arguments.get('--metrics'), results)
 
-    if do_runs:
-        dump_runs(**options)
-        update_meta('runs', now_str)
+    if not all([result['success'] for result in results]):
+        logger.error("-- Some endpoints failed. :(")
+        return 1
 
     logger.info("-- All done. :)")
 
 
 if __name__ == '__main__':
-    main(docopt(help, version=0.1))
+    sys.exit(main(docopt(help, version=0.1)))
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+import sys
+
+from docopt import docopt
+
+from rapidpro_tools import logger, change_logging_level
+from rapidpro_tools.mongo import ensure_indexes
+
+help = ("""Usage: ensure-indexes.py [-v] [-h]
+
+-h --help                       Display this help message
+-v --verbose                    Display DEBUG messages
+
+This script creates the mongo indexes used by the tools """
+        """if they do not exist yet """)
+
+
+def main(arguments):
+    debug = arguments.get('--verbose') or False
+    change_logging_level(debug)
+
+    report = ensure_indexes()
+
+    logger.info("{} created, {} already existing, {} failed."
+                .format(len(report['created']), len(report['existing']),
+                        len(report['failed'])))
+
+    if report['failed']:
+        return 1
+
+    logger.info("-- All done. :)")
+
+
+if __name__ == '__main__':
+    sys.exit(main(docopt(help, version=0.1)))
@@ -5,28 +5,55 @@
 from __future__ import (unicode_literals, absolute_import,
                         division, print_function)
 import datetime
-import json
-import os
+import sys
 from collections import OrderedDict
+from multiprocessing import Pool
 
 from docopt import docopt
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 from rapidpro_tools import logger, change_logging_level
 from rapidpro_tools.utils import (
     datetime_to_iso, datetime_from_iso, end_of_day, end_of_month,
-    nb_sms_for_messages, safe_percent, period_middle, in_period,
-    jsdthandler, js_timestamp, namesort)
-from rapidpro_tools.mongo import messages, relayers
+    nb_sms_for_message, nb_sms_expression, safe_percent, period_middle,
+    in_period, js_timestamp, namesort, write_json_output,
+    WRITTEN_ON_FIELD)
+from rapidpro_tools.mongo import (messages, relayers, rollups, meta,
+                                  ensure_indexes, aggregate, connect)
 
 destdir = ''
-
-help = ("""Usage: export-message-stats.py [-v] [-h] <destdir>
+STATS_FIELDS = ('nb_messages_in', 'nb_messages_out', 'nb_messages_total',
+                'nb_sms_in', 'nb_sms_out', 'nb_sms_total')
+ROLLUPS_META = 'daily_rollups'
+# messages are stamped by the dump host before being written: refreshes
+# overlap so that late writes and clock skew are not missed
+ROLLUPS_OVERLAP = datetime.timedelta(hours=1)
+# nb of messages encoded into numpy columns at once
+NUMPY_CHUNK_SIZE = 100000
+
+help = ("""Usage: export-message-stats.py [-v] [-h] [-e engine] """
+        """[-w workers] [-r date [-t date]] [-p] [-z] <destdir>
 
 -h --help                       Display this help message
 -v --verbose                    Display DEBUG messages
+-e --engine=<engine>            `rollups` (default) or `numpy` to count """
+        """messages
+                                from a single scan of the collection
+-w --workers=<nb_workers>       Generate up to <nb_workers> month files
+                                in parallel processes (defaults to 1)
+-r --rebuild-from=<date>        Rebuild daily rollups from <date>"""
+        """ (YYYY-MM-DD)
+-t --rebuild-to=<date>          End of rebuild (defaults to today)
+-p --pretty                     Write indented JSON files
+-z --gzip                       Write gzipped JSON files (.json.gz)
 <destdir>                       Folder for writing JSON files to.
 
-This script exports monthly + daily messages count stats in JSON """)
+This script exports monthly + daily messages count stats in JSON """
+        """from daily rollups, refreshed for messages written since """
+        """last export """)
 
 
 def get_relayers():
@@ -81,68 +108,226 @@ def query_dict_for(period):
     }
 
 
-def statistics_for(period):
-    logger.debug("statistics_for({})".format(period))
-
-    def dup(adict, bdict):
-        d = adict.copy()
-        d.update(bdict)
-        return d
-
-    query = dup({'status': {'$ne': 'F'}}, query_dict_for(period))
-    query_in = dup(query, {'direction': 'I'})
-    query_out = dup(query, {'direction': 'O'})
-    period_messages = messages.find(query)
-    relayer_ids = [r['relayer'] for r in get_relayers()]
+def period_days(period):
+    """ YYYY-MM-DD names of the days within period """
+    day = period['start_on'].date()
+    while day <= period['end_on'].date():
+        yield day.strftime('%Y-%m-%d')
+        day += datetime.timedelta(days=1)
+
+
+def days_query(start_on, end_on):
+    """ non-failed messages of the whole days from start_on to end_on """
+    query = {'status': {'$ne': 'F'}}
+    query.update(query_dict_for({
+        'start_on': datetime.datetime(
+            start_on.year, start_on.month, start_on.day),
+        'end_on': end_of_day(end_on.year, end_on.month, end_on.day)}))
+    return query
+
+
+def get_daily_counts(start_on, end_on):
+    """ non-failed messages and SMS by day, relayer and direction
+
+        {day: {(relayer, direction): [nb_messages, nb_sms]}} out of a
+        single aggregation over the whole days from start_on to end_on.
+        SMS parts are counted by mongo so no text leaves the server. """
+    logger.debug("get_daily_counts({}, {})".format(start_on, end_on))
+    pipeline = [
+        {'$match': days_query(start_on, end_on)},
+        {'$group': {
+            '_id': {
+                'day': {'$substr': ['$created_on', 0, 10]},
+                'relayer': '$relayer',
+                'direction': '$direction'},
+            'nb_messages': {'$sum': 1},
+            'nb_sms': {'$sum': nb_sms_expression('$text')}}},
+    ]
+    counts = {}
+    for row in aggregate(messages, pipeline):
+        group = row['_id']
+        counts.setdefault(group['day'], {})[
+            (group.get('relayer'), group.get('direction'))] = \
+            [row['nb_messages'], int(row['nb_sms'])]
+    return counts
+
+
+def empty_stats(relayer_ids):
+    return {
+        field: dict([('percent', {}), ('total', 0)]
+                    + [(relayer_id, 0) for relayer_id in relayer_ids])
+        for field in STATS_FIELDS}
 
-    stats = {
-        'nb_messages_in': {
-            'percent': {},
-            'total': messages.find(query_in).count()},
-        'nb_messages_out': {
-            'percent': {},
-            'total': messages.find(query_out).count()},
-        'nb_messages_total': {
-            'percent': {},
-            'total': period_messages.count()},
-        'nb_sms_in': {
-            'percent': {},
-            'total': nb_sms_for_messages(messages.find(query_in))},
-        'nb_sms_out': {
-            'percent': {},
-            'total': nb_sms_for_messages(messages.find(query_out))},
-        'nb_sms_total': {
-            'percent': {},
-            'total': nb_sms_for_messages(period_messages)},
-    }
 
-    for relayer_id in relayer_ids:
-        relayer_query = dup(query, {'relayer': relayer_id})
-        relayer_query_in = dup(relayer_query, {'direction': 'I'})
-        relayer_query_out = dup(relayer_query, {'direction': 'O'})
-        filtered = messages.find(relayer_query)
-
-        # messages are straight numbers from rapidpro
-        stats['nb_messages_total'][relayer_id] = filtered.count()
-        stats['nb_messages_in'][relayer_id] = \
-            messages.find(relayer_query_in).count()
-        stats['nb_messages_out'][relayer_id] = \
-            messages.find(relayer_query_out).count()
-
-        # SMS are computed to count multiparts
-        stats['nb_sms_total'][relayer_id] = nb_sms_for_messages(
-            filtered)
-        stats['nb_sms_in'][relayer_id] = nb_sms_for_messages(
-            messages.find(relayer_query_in))
-        stats['nb_sms_out'][relayer_id] = nb_sms_for_messages(
-            messages.find(relayer_query_out))
-
-    # update percentages
+def update_percentages(stats, relayer_ids):
     for field in stats.keys():
         for relayer_id in relayer_ids:
             stats[field]['percent'][relayer_id] = safe_percent(
                 stats[field][relayer_id], stats[field]['total'])
 
+
+def add_stats(astats, bstats, relayer_ids):
+    """ sum of two statistics_for() results """
+    stats = empty_stats(relayer_ids)
+    for field in STATS_FIELDS:
+        for key in ['total'] + relayer_ids:
+            stats[field][key] = astats[field][key] + bstats[field][key]
+    update_percentages(stats, relayer_ids)
+    return stats
+
+
+def refresh_rollups(start_on, end_on):
+    """ recomputes daily rollups of the whole days from start_on to end_on """
+    first_day = start_on.strftime('%Y-%m-%d')
+    last_day = end_on.strftime('%Y-%m-%d')
+    logger.info("Refreshing daily rollups from {} to {}"
+                .format(first_day, last_day))
+    counts = get_daily_counts(start_on, end_on)
+    rollups.remove({'day': {'$gte': first_day, '$lte': last_day}})
+    documents = [
+        {'day': day, 'relayer': relayer_id, 'direction': direction,
+         'nb_messages': values[0], 'nb_sms': values[1]}
+        for day, day_counts in counts.items()
+        for (relayer_id, direction), values in day_counts.items()]
+    if documents:
+        rollups.insert(documents)
+
+
+def written_days(since=None):
+    """ YYYY-MM-DD days holding messages written since `since`, sorted
+
+        every day with messages if since is None """
+    query = {} if since is None \
+        else {WRITTEN_ON_FIELD: {'$gte': datetime_to_iso(since)}}
+    return sorted([row['_id'] for row in aggregate(messages, [
+        {'$match': query},
+        {'$group': {'_id': {'$substr': ['$created_on', 0, 10]}}},
+    ]) if row['_id']])
+
+
+def day_ranges(days):
+    """ (first, last) datetimes of each run of consecutive sorted days """
+    ranges = []
+    for day in days:
+        day = datetime.datetime.strptime(day, '%Y-%m-%d')
+        if ranges and day - ranges[-1][1] == datetime.timedelta(days=1):
+            ranges[-1][1] = day
+        else:
+            ranges.append([day, day])
+    return [tuple(day_range) for day_range in ranges]
+
+
+def update_rollups(rebuild_from=None, rebuild_to=None):
+    """ refreshes the days touched by messages written since last update
+
+        days from rebuild_from to rebuild_to are recomputed regardless """
+    now = datetime.datetime.utcnow()
+    if rebuild_from is not None:
+        refresh_rollups(rebuild_from, rebuild_to or now)
+
+    updated_on = (meta.find_one({'endpoint': ROLLUPS_META}) or {}) \
+        .get('updated_on')
+    since = datetime_from_iso(updated_on) - ROLLUPS_OVERLAP \
+        if updated_on else None
+    # a backfilled old day is refreshed alone, not up to today
+    ranges = day_ranges(written_days(since))
+    for first_day, last_day in ranges:
+        refresh_rollups(first_day, last_day)
+    if not ranges:
+        logger.info("Daily rollups are up to date")
+    meta.update({'endpoint': ROLLUPS_META},
+                {'$set': {'updated_on': datetime_to_iso(now)}}, upsert=True)
+
+
+def get_rollup_counts(start_on, end_on):
+    """ get_daily_counts() alike, read from the daily rollups """
+    counts = {}
+    for rollup in rollups.find({'day': {
+            '$gte': start_on.strftime('%Y-%m-%d'),
+            '$lte': end_on.strftime('%Y-%m-%d')}}):
+        counts.setdefault(rollup['day'], {})[
+            (rollup.get('relayer'), rollup.get('direction'))] = \
+            [rollup['nb_messages'], rollup['nb_sms']]
+    return counts
+
+
+def get_numpy_counts(start_on, end_on):
+    """ get_daily_counts() alike, out of a single scan of the messages
+
+        messages are encoded by chunks into numpy columns (day index,
+        relayer/direction code and SMS parts) binned with bincount, so
+        memory depends on the chunk size and nb of days only. """
+    if np is None:
+        raise ImportError("The numpy engine requires numpy")
+
+    first_day = start_on.date()
+    nb_days = (end_on.date() - first_day).days + 1
+    day_names = [(first_day + datetime.timedelta(days=index))
+                 .strftime('%Y-%m-%d') for index in range(nb_days)]
+    day_indexes = {name: index for index, name in enumerate(day_names)}
+    # (relayer, direction) codes, in order of appearance
+    combos = {}
+
+    def binned(totals, days, codes, parts):
+        """ totals[count|sms, code, day] with the chunk columns added """
+        shape = (len(combos), nb_days)
+        keys = np.array(codes, dtype=np.int64) * nb_days \
+            + np.array(days, dtype=np.int32)
+        updated = np.zeros((2,) + shape, dtype=np.int64)
+        updated[:, :totals.shape[1]] = totals
+        updated[0] += np.bincount(
+            keys, minlength=shape[0] * shape[1]).reshape(shape)
+        updated[1] += np.bincount(
+            keys, weights=np.array(parts, dtype=np.int32),
+            minlength=shape[0] * shape[1]).astype(np.int64).reshape(shape)
+        return updated
+
+    totals = np.zeros((2, 0, nb_days), dtype=np.int64)
+    days, codes, parts = [], [], []
+    for message in messages.find(days_query(start_on, end_on),
+                                 {'_id': False, 'created_on': True,
+                                  'relayer': True, 'direction': True,
+                                  'text': True}):
+        combo = (message.get('relayer'), message.get('direction'))
+        if combo not in combos:
+            combos[combo] = len(combos)
+        days.append(day_indexes[message['created_on'][:10]])
+        codes.append(combos[combo])
+        parts.append(nb_sms_for_message(message))
+        if len(days) >= NUMPY_CHUNK_SIZE:
+            totals = binned(totals, days, codes, parts)
+            days, codes, parts = [], [], []
+    if days:
+        totals = binned(totals, days, codes, parts)
+
+    counts = {}
+    for combo, code in combos.items():
+        for index in np.flatnonzero(totals[0, code]):
+            counts.setdefault(day_names[index], {})[combo] = \
+                [int(totals[0, code, index]), int(totals[1, code, index])]
+    return counts
+
+
+def statistics_for(period, counts, relayer_ids):
+    logger.debug("statistics_for({})".format(period))
+
+    stats = empty_stats(relayer_ids)
+
+    for day in period_days(period):
+        for (relayer_id, direction), values in counts.get(day, {}).items():
+            # messages are straight numbers from rapidpro
+            # SMS are computed to count multiparts
+            for kind, value in zip(('messages', 'sms'), values):
+                fields = ['nb_{}_total'.format(kind)]
+                if direction in ('I', 'O'):
+                    fields.append('nb_{}_{}'.format(
+                        kind, 'in' if direction == 'I' else 'out'))
+                for field in fields:
+                    stats[field]['total'] += value
+                    if relayer_id in relayer_ids:
+                        stats[field][relayer_id] += value
+
+    update_percentages(stats, relayer_ids)
     return stats
 
 
@@ -155,27 +340,48 @@ def get_relayers_details():
     }
 
 
-def get_grand_total(start_on, end_on):
+def get_grand_total(start_on, end_on, stats):
     mperiod = {'name': "GRAND TOTAL", 'start_on': start_on, 'end_on': end_on}
     mperiod['middle'] = period_middle(mperiod['start_on'], mperiod['end_on'])
     mperiod['middle_ts'] = js_timestamp(mperiod['middle'])
-    return period_stats(mperiod)
+    mperiod['stats'] = stats
+    return mperiod
 
 
-def period_stats(period):
+def period_stats(period, counts, relayer_ids):
     d = period.copy()
-    d.update({'stats': statistics_for(period)})
+    d.update({'stats': statistics_for(period, counts, relayer_ids)})
     return d
 
 
-def get_months_stats(periods):
-    return {
-        period['name']: period_stats(period)
-        for period in sorted(periods['months'].values(), key=namesort)
-    }
+def init_worker():
+    """ gives each pool process its own mongo connection """
+    global messages, relayers, rollups
+    database = connect()
+    messages = database[messages.name]
+    relayers = database[relayers.name]
+    rollups = database[rollups.name]
 
 
-def generate_periods_stats(destdir='', start_on=None, end_on=None):
+def generate_month_stats(task):
+    """ writes the stats file of a month with entries for each day
+
+        returns the month stats and its days stats """
+    destdir, period, dperiods, engine, relayer_ids, output = task
+    logger.info("Generating {} stats by days".format(period['name']))
+    counts = ENGINES[engine](dperiods[0]['start_on'], dperiods[-1]['end_on'])
+    month_stats = OrderedDict([
+        (dperiod['name'], period_stats(dperiod, counts, relayer_ids))
+        for dperiod in dperiods
+    ])
+    if not write_json_output(destdir, period['name'], month_stats, **output):
+        logger.info("{} stats are unchanged".format(period['name']))
+    return period_stats(period, counts, relayer_ids), month_stats
+
+
+def generate_periods_stats(destdir='', start_on=None, end_on=None,
+                           engine='rollups', workers=1, pretty=False,
+                           gzipped=False):
 
     # when the DB is empty
     if not messages.count():
@@ -192,34 +398,28 @@ def generate_periods_stats(destdir='', start_on=None, end_on=None):
             messages.find().sort([('id', -1)]).limit(1)[0].get('created_on'))
 
     periods = get_periods(start_on=start_on, end_on=end_on)
+    relayer_ids = [r['relayer'] for r in get_relayers()]
 
-    # single statistics file with entries for each month
-    logger.info("Generating all-periods stats by months")
-    statistics = get_months_stats(periods)
-    statistics.update({
-        'relayers': get_relayers_details(),
-        'total': get_grand_total(start_on, end_on)
-    })
-    statistics['total'].update({'update_time': datetime.datetime.now()})
-    with open(os.path.join(destdir,
-                           'statistics.json'), 'w') as statistics_io:
-        json.dump(statistics, statistics_io, indent=4, default=jsdthandler)
-
-    # one stats file per month with entries for each day
-    for period in sorted(periods['months'].values(), key=namesort):
-        logger.info("Generating {} stats by days".format(period['name']))
-        month_stats = OrderedDict([
-            (dperiod['name'], period_stats(dperiod))
-            for dperiod in sorted(periods['days'].values(), key=namesort)
-            if in_period(period, dperiod['middle'])
-        ])
-        with open(os.path.join(destdir,
-                               '{}.json'.format(period['name'])), 'w') as io:
-            json.dump(month_stats, io, indent=4, default=jsdthandler)
-
-    # single cumulative stats file
-    logger.info("Generating cumulative stats by days")
-
+    # one stats file per month with entries for each day.
+    # months are counted independently so they can be spread on workers
+    logger.info("Counting messages by day with the {} engine".format(engine))
+    tasks = [
+        (destdir, period,
+         [dperiod for dperiod in sorted(periods['days'].values(),
+                                        key=namesort)
+          if in_period(period, dperiod['middle'])],
+         engine, relayer_ids, {'pretty': pretty, 'gzipped': gzipped})
+        for period in sorted(periods['months'].values(), key=namesort)]
+    pool = None
+    if workers > 1:
+        logger.info("Generating months stats with {} workers"
+                    .format(workers))
+        pool = Pool(workers, initializer=init_worker)
+        results = pool.imap(generate_month_stats, tasks)
+    else:
+        results = (generate_month_stats(task) for task in tasks)
+
+    # statistics and cumulative stats are summed up from months results
     def cperiod_for(period):
         p = period.copy()
         p.update({
@@ -228,13 +428,43 @@ def generate_periods_stats(destdir='', start_on=None, end_on=None):
             'middle_ts': js_timestamp(p['middle'])
         })
         return p
-    with open(os.path.join(destdir,
-                           'cumulative.json'), 'w') as io:
-        cumul_stats = OrderedDict([
-            (period['name'], period_stats(cperiod_for(period)))
-            for period in sorted(periods['days'].values(), key=namesort)
-        ])
-        json.dump(cumul_stats, io, indent=4, default=jsdthandler)
+    statistics = {}
+    total = empty_stats(relayer_ids)
+    cumul_stats = OrderedDict()
+    running = empty_stats(relayer_ids)
+    try:
+        for month_stats, days_stats in results:
+            statistics[month_stats['name']] = month_stats
+            total = add_stats(total, month_stats['stats'], relayer_ids)
+            for name, day_stats in days_stats.items():
+                running = add_stats(running, day_stats['stats'], relayer_ids)
+                cumul_stats[name] = cperiod_for(periods['days'][name])
+                cumul_stats[name].update({'stats': running})
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    # single statistics file with entries for each month
+    logger.info("Generating all-periods stats by months")
+    statistics.update({
+        'relayers': get_relayers_details(),
+        'total': get_grand_total(start_on, end_on, total)
+    })
+    statistics['total'].update({'update_time': datetime.datetime.now()})
+    write_json_output(destdir, 'statistics', statistics,
+                      pretty=pretty, gzipped=gzipped)
+
+    # single cumulative stats file, as running sums of the days stats
+    logger.info("Generating cumulative stats by days")
+    write_json_output(destdir, 'cumulative', cumul_stats,
+                      pretty=pretty, gzipped=gzipped)
+
+
+ENGINES = OrderedDict([
+    ('rollups', get_rollup_counts),
+    ('numpy', get_numpy_counts),
+])
 
 
 def main(arguments):
@@ -243,9 +473,40 @@ def main(arguments):
 
     logger.info("Generating JSON exports for message statistics")
 
-    generate_periods_stats(destdir=arguments.get('<destdir>') or None)
+    rebuild = {}
+    try:
+        for key in ('from', 'to'):
+            value = arguments.get('--rebuild-{}'.format(key))
+            rebuild[key] = datetime.datetime.strptime(value, '%Y-%m-%d') \
+                if value else None
+    except ValueError:
+        logger.error("Rebuild dates must be YYYY-MM-DD formatted")
+        return 1
+
+    engine = arguments.get('--engine') or 'rollups'
+    if engine not in ENGINES:
+        logger.error("Unknown engine `{}`. Available engines: {}"
+                     .format(engine, ", ".join(ENGINES.keys())))
+        return 1
+    if engine == 'numpy' and np is None:
+        logger.error("The numpy engine requires numpy")
+        return 1
+    if engine != 'rollups' and rebuild['from']:
+        logger.error("Rollups can only be rebuilt by the rollups engine")
+        return 1
+
+    ensure_indexes()
+
+    if engine == 'rollups':
+        update_rollups(rebuild_from=rebuild['from'],
+                       rebuild_to=rebuild['to'])
+    generate_periods_stats(destdir=arguments.get('<destdir>') or None,
+                           engine=engine,
+                           workers=int(arguments.get('--workers') or 1),
+                           pretty=arguments.get('--pretty') or False,
+                           gzipped=arguments.get('--gzip') or False)
 
     logger.info("All Done.")
 
 if __name__ == '__main__':
-    main(docopt(help, version=0.1))
+    sys.exit(main(docopt(help, version=0.1)))
@@ -5,27 +5,39 @@
 from __future__ import (unicode_literals, absolute_import,
                         division, print_function)
 import os
+import io
+import glob
+import hashlib
 import json
 from collections import OrderedDict
 import locale
 
 from py3compat import text_type, PY2
 from docopt import docopt
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 
 from rapidpro_tools import logger, change_logging_level
-from rapidpro_tools.utils import tssort, datetime_from_iso
+from rapidpro_tools.utils import (tssort, datetime_from_iso,
+                                  read_json_output, write_json_output,
+                                  write_atomic)
 
 locale.setlocale(locale.LC_ALL, '')
 jinja_env = Environment(loader=FileSystemLoader('.'))
 
-help = ("""Usage: generate-dashboard.py -j FOLDER [-o FILE] [-v] [-h]
+MONTH_TEMPLATE = 'dashboard_month_tmpl.html'
+
+help = ("""Usage: generate-dashboard.py -j FOLDER [-o FILE] [-s] """
+        """[-c FOLDER] [-v] [-h]
 
 -h --help                       Display this help message
 -v --verbose                    Display DEBUG messages
 -j --json=<folder>              Path to JSON directory
 -o --output=<path>              File path where to write HTML output"""
         """ (defaults to dashboard.html)
+-s --sidecars                   Write months chart data to <output>-data/
+                                JSON files loaded when a month is opened
+-c --cache=<folder>             Folder for compiled templates and rendered
+                                months (defaults to .dashboard-cache)
 
 This script generates a custom static HTML Dashboard """
         """from usms-dashboard JSON. """)
@@ -123,18 +135,79 @@ def multiply_items(data, ratio):
     return d
 
 
+def chart_columns(days_data, series):
+    """ columnar chart data: `ts` and one list of values per series
+
+        series maps a column name to its (field, relayer key) """
+    columns = OrderedDict([
+        ('ts', [int(day_data['middle_ts'])
+                for day_data in days_data.values()])])
+    for name, (field, key) in series.items():
+        columns[name] = [day_data['stats'][field][key]
+                         for day_data in days_data.values()]
+    return columns
+
+
+def chart_series(with_total=False):
+    series = OrderedDict()
+    if with_total:
+        series['nb_sms_total_total'] = ('nb_sms_total', 'total')
+    for relayer_id, (css, __) in RELAYERS.items():
+        for field in ('nb_sms_total', 'nb_sms_in', 'nb_sms_out'):
+            series['{}_{}'.format(field, css)] = (field, text_type(relayer_id))
+    return series
+
+
+def json_script(data):
+    """ JSON safe to inline in a <script> element """
+    return json.dumps(data, separators=(',', ':')).replace('</', '<\\/')
+
+
+def render_month(monthkey, month, context, cache_folder, template_digest):
+    """ HTML rows of a month, rendered once per month input
+
+        fragments are cached by a hash of the data they depend on
+        (and of the month template itself). """
+    digest = hashlib.sha1(json.dumps({
+        'template': template_digest,
+        'monthkey': monthkey,
+        'month': month,
+        'relayers': context['relayers'],
+        'fields': context['fields'],
+        'amount_fields': context['amount_fields'],
+    }, sort_keys=True).encode('utf-8')).hexdigest()
+
+    path = os.path.join(cache_folder, 'months',
+                        '{}-{}.html'.format(monthkey, digest))
+    if os.path.exists(path):
+        logger.debug("Using cached {} rows".format(monthkey))
+        with io.open(path, 'r', encoding='utf-8') as f:
+            return f.read()
+
+    logger.debug("Rendering {} rows".format(monthkey))
+    fragment = jinja_env.get_template(MONTH_TEMPLATE).render(
+        monthkey=monthkey, month=month, **context)
+    for stale_path in glob.glob(os.path.join(
+            cache_folder, 'months', '{}-*.html'.format(monthkey))):
+        os.remove(stale_path)
+    write_atomic(path, fragment.encode('utf-8'))
+    return fragment
+
+
 def main(arguments):
     debug = arguments.get('--verbose') or False
     change_logging_level(debug)
 
     json_folder = arguments.get('--json') or None
     html_path = arguments.get('--output') or "dashboard.html"
+    sidecars = arguments.get('--sidecars') or False
+    cache_folder = arguments.get('--cache') or ".dashboard-cache"
 
     logger.info("Generating Dashboard.")
 
     # load global statistics
-    with open(os.path.join(json_folder, 'statistics.json')) as f:
-        statistics = OrderedDict(sorted(json.load(f).items(), key=tssort))
+    statistics = OrderedDict(sorted(
+        read_json_output(json_folder, 'statistics').items(), key=tssort))
 
     # update stats with price data
     for key in statistics.keys():
@@ -149,16 +222,16 @@ def main(arguments):
 
     # load daily total for each month
     def loadjs(key):
-        with open(os.path.join(json_folder, '{}.json'.format(key)), 'r') as f:
-            return OrderedDict(sorted(json.load(f).items(), key=tssort))
+        return OrderedDict(sorted(read_json_output(json_folder, key).items(),
+                                  key=tssort))
     daily_data = {
         key: loadjs(key) for key in sorted(statistics.keys())
         if key not in ('total', 'relayers')
     }
 
     # cumulative values for each days
-    with open(os.path.join(json_folder, 'cumulative.json')) as f:
-        cumulative = OrderedDict(sorted(json.load(f).items(), key=tssort))
+    cumulative = OrderedDict(sorted(
+        read_json_output(json_folder, 'cumulative').items(), key=tssort))
 
     # list of fields to loop on
     fields = OrderedDict([
@@ -173,28 +246,65 @@ def main(arguments):
         ('estimated_price_total', "Coût estimatif TTC"),
     ])
 
+    relayers = OrderedDict(sorted(statistics['relayers'].items(),
+                                  key=lambda x: x[1]['relayer']))
+    months_data = OrderedDict([
+        (k, v) for k, v in sorted(statistics.items(), reverse=True)
+        if k != 'relayers'])
+
+    # single columnar payload the page builds its charts from
+    charts = OrderedDict([
+        (key, chart_columns(days_data, chart_series()))
+        for key, days_data in daily_data.items()])
+    charts['total'] = chart_columns(cumulative, chart_series(with_total=True))
+    payload = {
+        'relayers': [relayer['name'] for relayer in relayers.values()],
+        'pies': {
+            key: {field: [month['stats'][field]['percent'][relayer_id]
+                          for relayer_id in relayers.keys()]
+                  for field in fields.keys()}
+            for key, month in months_data.items()},
+        'charts': charts,
+        'sidecars': None,
+    }
+    if sidecars:
+        # months charts are fetched when their row is first opened
+        sidecars_folder = "{}-data".format(os.path.splitext(html_path)[0])
+        if not os.path.exists(sidecars_folder):
+            os.makedirs(sidecars_folder)
+        for key in daily_data.keys():
+            write_json_output(sidecars_folder, key, charts.pop(key))
+        payload['sidecars'] = os.path.basename(sidecars_folder)
+
+    # compiled templates are kept in between runs
+    if not os.path.exists(os.path.join(cache_folder, 'months')):
+        os.makedirs(os.path.join(cache_folder, 'months'))
+    jinja_env.bytecode_cache = FileSystemBytecodeCache(cache_folder)
+
+    # months rows only change with their own data
+    months_context = {
+        'relayers': relayers,
+        'fields': fields,
+        'amount_fields': [k for k in fields.keys()
+                          if k.startswith('estimated_')]
+    }
+    with open(MONTH_TEMPLATE, 'rb') as f:
+        template_digest = hashlib.sha1(f.read()).hexdigest()
+    months_fragments = [
+        render_month(monthkey, month, months_context, cache_folder,
+                     template_digest)
+        for monthkey, month in months_data.items()]
+
     # prepare context
     context = {
         'update_time': datetime_from_iso(
             statistics['total']['update_time']).strftime('%d %B %Y, %Hh%I')
                                                .decode('utf-8'),
-        'relayers': OrderedDict(sorted(statistics['relayers'].items(),
-                                       key=lambda x: x[1]['relayer'])),
-        'months_data': OrderedDict([
-            (k, v) for k, v in sorted(statistics.items(), reverse=True)
-            if k != 'relayers']),
-        'daily_data': daily_data,
-        'cumulative': cumulative,
-        'fields': fields,
-        'orange_id': ORANGE,
-        'malitel_id': MALITEL,
-        'orange_key': text_type(ORANGE),
-        'malitel_key': text_type(MALITEL),
-        'amount_fields': [k for k in fields.keys()
-                          if k.startswith('estimated_')]
+        'months_fragments': months_fragments,
+        'payload': json_script(payload),
     }
 
-    # render template in file
+    # assemble page from months fragments
     template = jinja_env.get_template('dashboard_tmpl.html')
     with open(html_path, 'w') as f:
         html = template.render(**context)
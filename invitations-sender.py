@@ -7,14 +7,13 @@ from __future__ import (unicode_literals, absolute_import,
 import math
 
 from rapidpro_tools import logger
-from rapidpro_tools.mongo import db, contacts
+from rapidpro_tools.mongo import contacts, numbers
 from rapidpro_tools.utils import post_api_data
 from rapidpro_mali import ORANGE, MALITEL, relayer_from_number
 
 INVIT_TEXT = ("Bonjour, tu es invité à rejoindre U-report pour partager "
               "tes opinions avec la jeunesse malienne. Pour t'inscrire, "
               "envoie \"MALI\" au 36019. C'est 100% gratuit.")
-numbers = db['numbers']
 
 
 def is_ureporter(number):
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+import datetime
+import math
+import random
+import time
+import uuid
+try:
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib import urlencode
+
+import cherrypy
+from docopt import docopt
+
+from rapidpro_tools import logger, change_logging_level
+from rapidpro_tools.utils import datetime_from_iso, datetime_to_iso
+
+help = ("""Usage: rapidpro-simulator.py [-v] [-h] [-p port] [-s seed] """
+        """[-n count] [-P size] [-l latency] [-e rate] [-t rate]
+
+-h --help                       Display this help message
+-v --verbose                    Display DEBUG messages
+-p --port=<port>                Port to listen on (defaults to 8000)
+-s --seed=<seed>                Seed for synthetic data (defaults to 0)
+-n --count=<nb_items>           Nb of messages, runs and contacts"""
+        """ (defaults to 10000)
+-P --page-size=<nb_items>       Nb of results per page (defaults to 100)
+-l --latency=<ms>               Added latency per request (defaults to 0)
+-e --error-rate=<ratio>         Ratio of requests failing with a 502
+-t --throttle-rate=<ratio>      Ratio of requests throttled with a 429
+
+This script serves synthetic data on the rapidpro v1 API endpoints """
+        """used by the tools (at /api/v1) for offline testing """)
+
+RELAYERS = [417, 485]
+END_ON = datetime.datetime(2015, 1, 1)
+# seconds between two consecutive synthetic items
+STEPS = {
+    'contacts': 3600,
+    'messages': 60,
+    'runs': 120,
+    'flows': 86400 * 7,
+}
+DIRECTIONS = ['I', 'O']
+STATUSES = ['H', 'S', 'D', 'F']
+WORDS = ["mali", "ureport", "bonjour", "merci", "oui", "non", "sante",
+         "ecole", "jeunesse", "opinion", "bamako", "sondage"]
+
+
+def item_uuid(rng):
+    return "{}".format(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def item_date(endpoint, index):
+    return END_ON - datetime.timedelta(seconds=STEPS[endpoint] * index)
+
+
+def make_contact(rng, index, total, created_on):
+    phone = "+223{}{:07d}".format(rng.choice('6789'), rng.randint(0, 9999999))
+    return {
+        'uuid': item_uuid(rng),
+        'name': "Contact {}".format(index),
+        'urns': ["tel:{}".format(phone)],
+        'phone': phone,
+        'groups': ["U-Reporters"],
+        'fields': {
+            'born': "{}".format(rng.randint(1960, 2005)),
+            'gender': rng.choice(["Homme", "Femme"]),
+            'milieu': rng.choice(["Ville", "Village"]),
+            'activit': rng.choice(["Etudiant", "Travaille"]),
+            'state': rng.choice(["District de Bamako", "Kayes", "Mopti"]),
+            'registration_date': datetime_to_iso(created_on),
+        },
+        'language': "fre",
+        'modified_on': datetime_to_iso(created_on),
+    }
+
+
+def make_message(rng, index, total, created_on):
+    text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 60)))
+    return {
+        'id': total - index,
+        'contact': item_uuid(rng),
+        'relayer': rng.choice(RELAYERS),
+        'urn': "tel:+223{:08d}".format(rng.randint(60000000, 99999999)),
+        'direction': rng.choice(DIRECTIONS),
+        'type': "F",
+        'status': rng.choice(STATUSES),
+        'labels': [],
+        'text': text,
+        'created_on': datetime_to_iso(created_on),
+        'sent_on': datetime_to_iso(created_on),
+        'delivered_on': None,
+    }
+
+
+def make_run(rng, index, total, created_on):
+    flow_uuid = item_uuid(rng)
+    steps = [{'node': item_uuid(rng),
+              'text': rng.choice(WORDS),
+              'value': rng.choice(WORDS),
+              'left_on': datetime_to_iso(created_on),
+              'arrived_on': datetime_to_iso(created_on),
+              'type': rng.choice(['A', 'R'])}
+             for _ in range(rng.randint(1, 8))]
+    return {
+        'run': total - index,
+        'flow_uuid': flow_uuid,
+        'contact': item_uuid(rng),
+        'completed': rng.choice([True, False]),
+        'values': [{'node': step['node'],
+                    'category': step['value'],
+                    'text': step['text'],
+                    'value': step['value'],
+                    'label': step['text'],
+                    'time': step['left_on']}
+                   for step in steps if step['type'] == 'R'],
+        'steps': steps,
+        'created_on': datetime_to_iso(created_on),
+        'modified_on': datetime_to_iso(created_on),
+    }
+
+
+def make_flow(rng, index, total, created_on):
+    nb_runs = rng.randint(0, 5000)
+    return {
+        'uuid': item_uuid(rng),
+        'name': "Flow {}".format(index),
+        'archived': False,
+        'labels': [],
+        'runs': nb_runs,
+        'completed_runs': rng.randint(0, nb_runs),
+        'rulesets': [],
+        'created_on': datetime_to_iso(created_on),
+        'expires': 720,
+    }
+
+
+def make_field(rng, index, total, created_on):
+    return {'key': "field_{}".format(index),
+            'label': "Field {}".format(index),
+            'value_type': rng.choice(['T', 'N', 'D'])}
+
+
+def make_relayer(rng, index, total, created_on):
+    return {'relayer': RELAYERS[index],
+            'phone': "36019",
+            'name': ["Orange", "Malitel"][index],
+            'country': "ML",
+            'power_level': rng.randint(0, 100),
+            'power_status': "STATUS_CHARGING",
+            'power_source': "SOURCE_AC",
+            'network_type': "WIFI",
+            'pending_message_count': 0,
+            'last_seen': datetime_to_iso(created_on)}
+
+
+class RapidProSimulator(object):
+
+    def __init__(self, seed=0, count=10000, page_size=100, latency=0,
+                 error_rate=0, throttle_rate=0):
+        self.seed = seed
+        self.page_size = page_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.faults = random.Random(seed)
+        self.endpoints = {
+            'contacts': (make_contact, count),
+            'messages': (make_message, count),
+            'runs': (make_run, count),
+            'flows': (make_flow, max(1, count // 1000)),
+            'fields': (make_field, 20),
+            'relayers': (make_relayer, len(RELAYERS)),
+        }
+
+    def inject_faults(self):
+        if self.latency:
+            time.sleep(self.latency / 1000)
+        if self.faults.random() < self.throttle_rate:
+            cherrypy.response.headers['Retry-After'] = "1"
+            raise cherrypy.HTTPError("429 Too Many Requests")
+        if self.faults.random() < self.error_rate:
+            raise cherrypy.HTTPError("502 Bad Gateway")
+
+    def item(self, endpoint, index):
+        func, total = self.endpoints[endpoint]
+        rng = random.Random("{}-{}-{}".format(self.seed, endpoint, index))
+        created_on = item_date(endpoint, index) \
+            if endpoint in STEPS else END_ON
+        return func(rng, index, total, created_on)
+
+    def index_range(self, endpoint, after=None, before=None):
+        """ [first, last) indexes of items matching after/before """
+        total = self.endpoints[endpoint][1]
+        if endpoint not in STEPS:
+            return 0, total
+
+        # items are ordered newest first, STEPS[endpoint] seconds apart
+        def index_of(adate):
+            delta = (END_ON - datetime_from_iso(adate)).total_seconds()
+            return delta / STEPS[endpoint]
+
+        first = 0
+        last = total
+        if before is not None:
+            first = max(first, int(math.ceil(index_of(before))))
+        if after is not None:
+            last = min(last, int(math.floor(index_of(after))) + 1)
+        return first, max(first, last)
+
+    def serve(self, endpoint, page=1, after=None, before=None, **params):
+        self.inject_faults()
+        page = int(page)
+        first, last = self.index_range(endpoint, after, before)
+        count = last - first
+        start = first + (page - 1) * self.page_size
+        end = min(last, start + self.page_size)
+        if page > 1 and start >= last:
+            # as the v1 API does for pages past the last one
+            raise cherrypy.HTTPError(404, "Invalid page.")
+
+        next_url = None
+        if end < last:
+            query = {'page': page + 1}
+            if after is not None:
+                query.update({'after': after})
+            if before is not None:
+                query.update({'before': before})
+            next_url = cherrypy.url(qs=urlencode(query))
+
+        return {
+            'count': count,
+            'next': next_url,
+            'previous': None,
+            'results': [self.item(endpoint, index)
+                        for index in range(start, end)],
+        }
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def contacts_json(self, **params):
+        return self.serve('contacts', **params)
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def messages_json(self, **params):
+        return self.serve('messages', **params)
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def runs_json(self, **params):
+        return self.serve('runs', **params)
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def flows_json(self, **params):
+        return self.serve('flows', **params)
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def fields_json(self, **params):
+        return self.serve('fields', **params)
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def relayers_json(self, **params):
+        return self.serve('relayers', **params)
+
+
+def main(arguments):
+    debug = arguments.get('--verbose') or False
+    change_logging_level(debug)
+
+    simulator = RapidProSimulator(
+        seed=int(arguments.get('--seed') or 0),
+        count=int(arguments.get('--count') or 10000),
+        page_size=int(arguments.get('--page-size') or 100),
+        latency=int(arguments.get('--latency') or 0),
+        error_rate=float(arguments.get('--error-rate') or 0),
+        throttle_rate=float(arguments.get('--throttle-rate') or 0))
+
+    port = int(arguments.get('--port') or 8000)
+    logger.info("Serving simulated rapidpro API on "
+                "http://127.0.0.1:{}/api/v1".format(port))
+
+    cherrypy.config.update({
+        'server.socket_host': '127.0.0.1',
+        'server.socket_port': port,
+        'server.thread_pool': 30,
+        'engine.autoreload.on': False,
+        'log.screen': debug,
+    })
+    cherrypy.quickstart(simulator, '/api/v1')
+
+
+if __name__ == '__main__':
+    main(docopt(help, version=0.1))
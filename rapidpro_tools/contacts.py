@@ -9,7 +9,8 @@ from py3compat import PY2
 
 from rapidpro_tools import logger
 from rapidpro_tools.mongo import contacts
-from rapidpro_tools.utils import post_api_data
+from rapidpro_tools.utils import (post_api_data, content_hash,
+                                  CONTENT_HASH_FIELD)
 
 if PY2:
     import unicodecsv as csv
@@ -39,7 +40,9 @@ def update_contact(contact, fields=None, name=None, groups=None):
         return False
 
     # upload edits
-    contact.update(post_api_data('/contacts.json', update_dict))
+    updated = post_api_data('/contacts.json', update_dict)
+    contact.update(updated)
+    contact[CONTENT_HASH_FIELD] = content_hash(updated)
 
     # save returned (updated) contacts details in DB
     contacts.save(contact)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+import os
+import threading
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+# upper bounds (in seconds) of the HTTP latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# bytes are counted as received (gzipped), decoded_bytes once inflated
+COUNTERS = ('requests', 'retries', 'throttles', 'errors', 'bytes',
+            'decoded_bytes', 'decode_time')
+PROMETHEUS_PREFIX = 'rapidpro_dump'
+
+
+def endpoint_from_url(url):
+    """ API endpoint name (messages, contacts...) of an API URL """
+    name = os.path.basename(urlparse(url).path.rstrip('/'))
+    if name.endswith('.json'):
+        name = name[:-len('.json')]
+    return name or None
+
+
+class EndpointMetrics(object):
+    """ thread-safe HTTP counters and latency histogram of an endpoint """
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.lock = threading.Lock()
+        self.counters = {counter: 0 for counter in COUNTERS}
+        self.buckets = [0 for bucket in LATENCY_BUCKETS]
+        self.latency_count = 0
+        self.latency_sum = 0
+
+    def incr(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] += value
+
+    def observe_latency(self, seconds):
+        with self.lock:
+            self.latency_count += 1
+            self.latency_sum += seconds
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    self.buckets[index] += 1
+                    break
+
+    def latency_quantile(self, quantile):
+        """ upper bound of the bucket holding quantile
+
+            None if empty or above the last bucket (no JSON Infinity) """
+        if not self.latency_count:
+            return None
+        seen = 0
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            seen += self.buckets[index]
+            if seen >= quantile * self.latency_count:
+                return bound
+        return None
+
+    def as_dict(self):
+        with self.lock:
+            data = dict(self.counters)
+            data['latency'] = {
+                'count': self.latency_count,
+                'sum': self.latency_sum,
+                # cumulative, as in prometheus histograms
+                'buckets': [[bound, sum(self.buckets[:index + 1])]
+                            for index, bound in enumerate(LATENCY_BUCKETS)],
+            }
+        data['latency']['p50'] = self.latency_quantile(0.5)
+        data['latency']['p95'] = self.latency_quantile(0.95)
+        return data
+
+
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+
+def get_metrics(url_or_endpoint):
+    """ shared EndpointMetrics for an endpoint name or API URL """
+    endpoint = endpoint_from_url(url_or_endpoint) \
+        if '/' in url_or_endpoint else url_or_endpoint
+    with _metrics_lock:
+        if endpoint not in _metrics:
+            _metrics[endpoint] = EndpointMetrics(endpoint)
+    return _metrics[endpoint]
+
+
+def prometheus_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def prometheus_text(results):
+    """ prometheus text exposition of dump-rapidpro.py results
+
+        each result being a run_dump() dict with its totals and metrics """
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        name = '{}_{}'.format(PROMETHEUS_PREFIX, name)
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for suffix, labels, value in samples:
+            lines.append('{}{}{{{}}} {}'.format(
+                name, suffix,
+                ','.join(['{}="{}"'.format(key, val)
+                          for key, val in labels]),
+                prometheus_value(value)))
+
+    def per_endpoint(getter):
+        return [('', [('endpoint', result['endpoint'])], getter(result))
+                for result in results]
+
+    def total(key):
+        return per_endpoint(lambda r: r['totals'].get(key, 0))
+
+    def counter(key):
+        return per_endpoint(lambda r: r.get('metrics', {}).get(key, 0))
+
+    metric('success', 'gauge', "1 if the endpoint dump succeeded.",
+           per_endpoint(lambda r: int(r['success'])))
+    metric('duration_seconds', 'gauge', "Duration of the endpoint dump.",
+           per_endpoint(lambda r: r['duration']))
+    metric('pages_total', 'counter', "API pages written.", total('pages'))
+    metric('documents_total', 'counter', "API items written.",
+           total('documents'))
+    metric('written_documents_total', 'counter',
+           "Written items by outcome.",
+           [('', [('endpoint', result['endpoint']), ('outcome', outcome)],
+             result['totals'].get(outcome, 0))
+            for result in results
+            for outcome in ('inserted', 'updated', 'unchanged')])
+    metric('write_seconds_total', 'counter', "Time spent writing pages.",
+           total('write_time'))
+    metric('decode_seconds_total', 'counter',
+           "Time spent decoding API JSON.", counter('decode_time'))
+    metric('received_bytes_total', 'counter',
+           "Bytes of API responses as received on the wire.",
+           counter('bytes'))
+    metric('decoded_bytes_total', 'counter',
+           "Bytes of API responses once decompressed.",
+           counter('decoded_bytes'))
+    metric('requests_total', 'counter', "API requests sent.",
+           counter('requests'))
+    metric('retries_total', 'counter', "API requests retried.",
+           counter('retries'))
+    metric('throttles_total', 'counter', "API requests throttled (429).",
+           counter('throttles'))
+    metric('errors_total', 'counter',
+           "API requests failed (connection, timeout or 5xx).",
+           counter('errors'))
+
+    samples = []
+    for result in results:
+        latency = result.get('metrics', {}).get('latency')
+        if latency is None:
+            continue
+        labels = [('endpoint', result['endpoint'])]
+        for bound, count in latency['buckets']:
+            samples.append(('_bucket', labels + [('le', bound)], count))
+        samples.append(('_bucket', labels + [('le', '+Inf')],
+                        latency['count']))
+        samples.append(('_sum', labels, latency['sum']))
+        samples.append(('_count', labels, latency['count']))
+    metric('http_latency_seconds', 'histogram',
+           "Latency of API responses.", samples)
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(path, results):
+    """ writes results as a prometheus text file (node_exporter style) """
+    # utils records its requests here, it can not be imported on load
+    from rapidpro_tools.utils import write_atomic
+    write_atomic(path, prometheus_text(results).encode('utf-8'))
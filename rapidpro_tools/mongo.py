@@ -5,9 +5,17 @@
 from __future__ import (unicode_literals, absolute_import,
                         division, print_function)
 
-from pymongo import MongoClient
+import pymongo
+from pymongo import MongoClient, ASCENDING
+
+from rapidpro_tools import CONFIG, logger
+from rapidpro_tools.utils import WRITTEN_ON_FIELD
+
+
+def connect():
+    """ database through a new client (clients do not survive a fork) """
+    return MongoClient(CONFIG.get('mongo_url'))[CONFIG.get('mongo_database')]
 
-from rapidpro_tools import CONFIG
 
 client = MongoClient(CONFIG.get('mongo_url'))
 db = client[CONFIG.get('mongo_database')]
@@ -19,3 +27,66 @@ messages = db['messages']
 flows = db['flows']
 runs = db['runs']
 fields = db['fields']
+numbers = db['numbers']
+rollups = db['daily_rollups']
+
+# (collection, key spec, unique) for every index the tools rely on
+INDEXES = [
+    (meta, [('endpoint', ASCENDING)], True),
+    (contacts, [('uuid', ASCENDING)], True),
+    (contacts, [('phone', ASCENDING)], False),
+    (relayers, [('relayer', ASCENDING)], True),
+    (messages, [('id', ASCENDING)], True),
+    (flows, [('uuid', ASCENDING)], True),
+    (runs, [('run', ASCENDING)], True),
+    (fields, [('key', ASCENDING)], True),
+    (numbers, [('number', ASCENDING)], True),
+    # message statistics $match
+    (messages, [('created_on', ASCENDING)], False),
+    # daily rollups refresh
+    (messages, [(WRITTEN_ON_FIELD, ASCENDING)], False),
+    (rollups, [('day', ASCENDING), ('relayer', ASCENDING),
+               ('direction', ASCENDING)], True),
+]
+
+
+def ensure_indexes():
+    """ creates missing indexes, returns created/existing/failed names """
+    report = {'created': [], 'existing': [], 'failed': []}
+    for collection, keys, unique in INDEXES:
+        name = "{}.{}".format(
+            collection.name,
+            "_".join(["{}_{}".format(key, order) for key, order in keys]))
+        existing = {
+            tuple([tuple(key) for key in index['key']]):
+            index.get('unique', False)
+            for index in collection.index_information().values()}
+        if tuple(keys) in existing:
+            if existing[tuple(keys)] != unique:
+                # can not be changed in place, it has to be dropped first
+                logger.warning("Index {} already exists but {} unique"
+                               .format(name, "is not" if unique else "is"))
+                report['failed'].append(name)
+                continue
+            logger.debug("Index {} already exists".format(name))
+            report['existing'].append(name)
+            continue
+        try:
+            collection.create_index(keys, unique=unique, background=True)
+        except Exception as e:
+            logger.error("Unable to create index {}: {}".format(name, e))
+            report['failed'].append(name)
+        else:
+            logger.info("Created index {}".format(name))
+            report['created'].append(name)
+    return report
+
+
+def aggregate(collection, pipeline):
+    """ iterable of aggregation results, as a cursor on any pymongo
+
+        pymongo 2 returns a single (16MB capped) document unless asked
+        for a cursor. """
+    if pymongo.version_tuple[0] < 3:
+        return collection.aggregate(pipeline, allowDiskUse=True, cursor={})
+    return collection.aggregate(pipeline, allowDiskUse=True)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+import gzip
+import io
+import json
+import os
+import threading
+
+from rapidpro_tools import logger
+from rapidpro_tools.utils import write_atomic
+
+MANIFEST = 'manifest.json'
+SEGMENT_SIZE = 100000
+
+
+def read_manifest(directory, endpoint):
+    path = os.path.join(directory, endpoint, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with io.open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+class SegmentWriter(object):
+    """ writes an endpoint as rolling gzipped NDJSON segment files
+
+        <directory>/<endpoint>/manifest.json lists the completed segments
+        along with the endpoint meta (watermark, checkpoint...).
+        the manifest is only saved when a segment is completed so that
+        it never refers to data which is not on disk. """
+
+    def __init__(self, directory, endpoint, segment_size=SEGMENT_SIZE):
+        self.directory = os.path.join(directory, endpoint)
+        self.endpoint = endpoint
+        self.segment_size = segment_size
+        self.lock = threading.RLock()
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        self.manifest = read_manifest(directory, endpoint) or {
+            'endpoint': endpoint,
+            'id_field': None,
+            'segments': [],
+            'meta': {},
+        }
+        self.segment = None
+        self.segment_path = None
+        self.segment_documents = 0
+
+    @property
+    def meta(self):
+        return self.manifest['meta']
+
+    @property
+    def nb_documents(self):
+        return sum([segment['documents']
+                    for segment in self.manifest['segments']]) \
+            + self.segment_documents
+
+    def update_meta(self, updates):
+        """ sets meta fields (dotted for nested), None removes them """
+        with self.lock:
+            for key, value in updates.items():
+                target = self.meta
+                parts = key.split('.')
+                for part in parts[:-1]:
+                    target = target.setdefault(part, {})
+                if value is None:
+                    target.pop(parts[-1], None)
+                else:
+                    target[parts[-1]] = value
+
+    def open_segment(self):
+        name = '{}-{:05d}.ndjson.gz'.format(
+            self.endpoint, len(self.manifest['segments']))
+        self.segment_path = os.path.join(self.directory, name)
+        self.segment = gzip.open('{}.tmp'.format(self.segment_path), 'wb')
+        self.segment_documents = 0
+
+    def close_segment(self):
+        if self.segment is None:
+            return
+        self.segment.close()
+        os.rename('{}.tmp'.format(self.segment_path), self.segment_path)
+        self.manifest['segments'].append({
+            'file': os.path.basename(self.segment_path),
+            'documents': self.segment_documents,
+            'bytes': os.path.getsize(self.segment_path),
+        })
+        logger.debug("Completed segment {}".format(self.segment_path))
+        self.segment = None
+        self.segment_documents = 0
+        self.save_manifest()
+
+    def save_manifest(self):
+        write_atomic(os.path.join(self.directory, MANIFEST),
+                     json.dumps(self.manifest, indent=4, ensure_ascii=False)
+                     .encode('utf-8'))
+
+    def write_page(self, data, id_field):
+        """ appends page results, returns a update_collection-like report """
+        report = {'inserted': 0, 'updated': 0, 'unchanged': 0,
+                  'documents': 0}
+        with self.lock:
+            self.manifest['id_field'] = id_field
+            for item in data.get('results') or []:
+                if self.segment is None:
+                    self.open_segment()
+                self.segment.write(json.dumps(item, separators=(',', ':'))
+                                   .encode('utf-8') + b'\n')
+                self.segment_documents += 1
+                report['documents'] += 1
+                if self.segment_documents >= self.segment_size:
+                    self.close_segment()
+        report['inserted'] = report['documents']
+        return report
+
+    def close(self):
+        """ completes current segment and saves manifest """
+        with self.lock:
+            if self.segment is not None:
+                self.close_segment()
+            else:
+                self.save_manifest()
+
+
+def iter_segment_items(directory, endpoint):
+    """ yields every item of the endpoint segments, in written order """
+    manifest = read_manifest(directory, endpoint)
+    if manifest is None:
+        return
+    for segment in manifest['segments']:
+        path = os.path.join(directory, endpoint, segment['file'])
+        with gzip.open(path, 'rb') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line.decode('utf-8'))
+
+
+def iter_segment_pages(directory, endpoint, page_size):
+    """ segment items grouped in API-like pages of page_size items """
+    results = []
+    for item in iter_segment_items(directory, endpoint):
+        results.append(item)
+        if len(results) >= page_size:
+            yield {'count': len(results), 'next': None, 'results': results}
+            results = []
+    if results:
+        yield {'count': len(results), 'next': None, 'results': results}
@@ -4,20 +4,49 @@
 
 from __future__ import (unicode_literals, absolute_import,
                         division, print_function)
+import codecs
+import gzip
+import hashlib
+import io
 import math
 import datetime
 import json
+import os
+import random
 import re
+import threading
+import time
+from email.utils import parsedate_tz, mktime_tz
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
 
 import iso8601
 import requests
 
 from rapidpro_tools import CONFIG, logger
+from rapidpro_tools.metrics import get_metrics
 
 UTC = iso8601.iso8601.Utc()
 ASCII_MAX_CHARS = 160
 UNICODE_MAX_CHARS = 72
-TIMEOUT = 120
+CONNECT_TIMEOUT = CONFIG.get('connect_timeout', 10)
+READ_TIMEOUT = CONFIG.get('read_timeout', 120)
+TIMEOUT = (CONNECT_TIMEOUT, READ_TIMEOUT)
+MAX_RETRIES = CONFIG.get('max_retries', 5)
+BACKOFF_FACTOR = CONFIG.get('backoff_factor', 1)
+BACKOFF_MAX = 60
+POOL_SIZE = 10
+STREAM_CHUNK_SIZE = 16 * 1024
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+THROTTLED_STATUS_CODE = 429
+RATE_LIMIT = CONFIG.get('rate_limit', 5)
+MIN_RATE_LIMIT = 0.1
+SLOW_LATENCY_RATIO = 3
+SLOW_LATENCY_MIN = 1
+CONTENT_HASH_FIELD = '_content_hash'
+WRITTEN_ON_FIELD = '_written_on'
 
 jsdthandler = lambda obj: obj.isoformat() \
     if isinstance(obj, datetime.datetime) \
@@ -96,6 +125,25 @@ def nb_sms_for_messages(cursor):
     return sum([nb_sms_for_message(m) for m in cursor])
 
 
+def nb_sms_expression(text='$text'):
+    """ aggregation expression of nb_sms_for_message() (MongoDB 3.4+) """
+    nb_max = ASCII_MAX_CHARS \
+        if not CONFIG['relayers_unicode'] else UNICODE_MAX_CHARS
+    length = {'$strLenCP': {'$ifNull': [text, '']}}
+    return {'$cond': [{'$lt': [length, UNICODE_MAX_CHARS]},
+                      1,
+                      {'$ceil': {'$divide': [length, nb_max]}}]}
+
+
+def content_hash(item):
+    """ stable digest of an API item, ignoring local (_prefixed) keys """
+    payload = {key: value for key, value in item.items()
+               if not key.startswith('_')}
+    return hashlib.sha1(json.dumps(payload, sort_keys=True,
+                                   separators=(',', ':'))
+                        .encode('utf-8')).hexdigest()
+
+
 def safe_percent(nomin, denomin, default=0):
     try:
         return nomin / denomin
@@ -107,19 +155,206 @@ def in_period(period, adate):
     return adate >= period['start_on'] and adate <= period['end_on']
 
 
-def get_api_data(url_or_path, **params):
-    headers = {'Authorization': "Token {}".format(CONFIG.get("api_token"))}
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """ shared keep-alive session with a connection pool for the API host """
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers.update({
+                'Authorization': "Token {}".format(CONFIG.get("api_token")),
+                'Accept-Encoding': 'gzip, deflate',
+            })
+            _session = session
+    return _session
+
+
+class RateLimiter(object):
+    """ adaptive token bucket throttling requests to a single host
+
+        rate is halved when the server throttles us or latency rises
+        well above its average and slowly raised back to max_rate
+        as long as responses come back fast. """
+
+    def __init__(self, max_rate, min_rate=MIN_RATE_LIMIT):
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.rate = max_rate
+        self.capacity = max(1, max_rate)
+        self.tokens = self.capacity
+        self.updated_at = time.time()
+        self.blocked_until = 0
+        self.latency = None
+        self.last_decrease = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ blocks until a request can be sent """
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens
+                                  + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.blocked_until - now,
+                           (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def decrease(self):
+        now = time.time()
+        # one decrease per second so a burst of slow responses
+        # does not collapse the rate
+        if now - self.last_decrease < 1:
+            return
+        self.last_decrease = now
+        self.rate = max(self.min_rate, self.rate / 2)
+        logger.warning("Lowering API rate to {:.2f} req/s"
+                       .format(self.rate))
+
+    def increase(self):
+        self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+    def throttled(self, retry_after=None):
+        with self.lock:
+            self.decrease()
+            if retry_after:
+                self.blocked_until = max(self.blocked_until,
+                                         time.time() + retry_after)
+
+    def record(self, latency):
+        with self.lock:
+            if self.latency is not None and latency > SLOW_LATENCY_MIN \
+                    and latency > self.latency * SLOW_LATENCY_RATIO:
+                self.decrease()
+            elif self.rate < self.max_rate:
+                self.increase()
+            self.latency = latency if self.latency is None \
+                else self.latency * 0.9 + latency * 0.1
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(url):
+    """ shared RateLimiter for the host of url """
+    host = urlparse(url).netloc
+    with _rate_limiters_lock:
+        if host not in _rate_limiters:
+            _rate_limiters[host] = RateLimiter(RATE_LIMIT)
+    return _rate_limiters[host]
+
+
+def retry_after_seconds(response):
+    """ Retry-After header value in seconds (delay or HTTP date) """
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        parsed = parsedate_tz(value)
+        if parsed is None:
+            return None
+        return max(0, mktime_tz(parsed) - time.time())
+
+
+def api_url(url_or_path):
     if url_or_path.startswith('http'):
-        url = url_or_path
-    else:
-        url = "{server}{path}" \
-              .format(server=CONFIG.get('server_url'), path=url_or_path)
+        return url_or_path
+    return "{server}{path}".format(server=CONFIG.get('server_url'),
+                                   path=url_or_path)
+
+
+def backoff_delay(attempt):
+    """ exponential backoff with full jitter for the nth retry """
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_FACTOR * 2 ** attempt))
+
+
+def api_request(method, url, idempotent=True, **kwargs):
+    """ sends request through the shared session and host rate limiter
+
+        throttled (429) requests are retried once Retry-After has passed.
+        idempotent requests are also retried on connection errors,
+        timeouts and 5xx responses, waiting backoff_delay() in between. """
+    limiter = get_rate_limiter(url)
+    metrics = get_metrics(url)
+    retries = MAX_RETRIES if idempotent else 0
+    attempt = 0
+    while True:
+        delay = None
+        limiter.acquire()
+        metrics.incr('requests')
+        started_on = time.time()
+        try:
+            r = get_session().request(method, url, timeout=TIMEOUT, **kwargs)
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout) as e:
+            metrics.incr('errors')
+            if attempt >= retries:
+                raise
+            logger.warning("{} on {} {}. Retrying ({}/{})."
+                           .format(e.__class__.__name__, method, url,
+                                   attempt + 1, retries))
+        else:
+            if r.status_code == THROTTLED_STATUS_CODE:
+                metrics.incr('throttles')
+                delay = retry_after_seconds(r)
+                limiter.throttled(delay)
+                if attempt >= MAX_RETRIES:
+                    return r
+                logger.warning("Throttled on {} {}. Retrying ({}/{})."
+                               .format(method, url,
+                                       attempt + 1, MAX_RETRIES))
+            else:
+                latency = time.time() - started_on
+                limiter.record(latency)
+                metrics.observe_latency(latency)
+                if r.status_code in RETRY_STATUS_CODES:
+                    metrics.incr('errors')
+                if r.status_code not in RETRY_STATUS_CODES \
+                        or attempt >= retries:
+                    return r
+                logger.warning("Received {} HTTP status code on {} {}. "
+                               "Retrying ({}/{})."
+                               .format(r.status_code, method, url,
+                                       attempt + 1, retries))
+            # a discarded streamed response would hold its connection
+            r.close()
+        # Retry-After is enforced by the limiter itself
+        if delay is None:
+            time.sleep(backoff_delay(attempt))
+        metrics.incr('retries')
+        attempt += 1
+
+
+class APIError(AssertionError):
+    """ non-OK response of the API """
+
+    def __init__(self, status_code, url):
+        super(APIError, self).__init__(
+            "Received {} HTTP status code on {}".format(status_code, url))
+        self.status_code = status_code
+
+
+def get_api_response(url_or_path, stream=False, **params):
+    url = api_url(url_or_path)
     logger.debug("URL: {}?{}".format(
         url, "&".join(["{key}={val}".format(key=key, val=val)
                        for key, val in params.items()])))
     try:
-        r = requests.get(url=url, headers=headers, params=params,
-                         timeout=TIMEOUT)
+        r = api_request('GET', url, params=params, stream=stream)
         assert r.status_code == requests.codes.ok
     except AssertionError:
         if r.status_code in (403, 401):
@@ -127,32 +362,69 @@ def get_api_data(url_or_path, **params):
                 "Received {code} HTTP status code. Most likely "
                 "a wrong API TOKEN in config ({token})."
                 .format(code=r.status_code, token=CONFIG.get('api_token')))
-        elif r.status_code == 404:
+        elif r.status_code == 404 and not params.get('page'):
             logger.error(
                 "Received {code} HTTP status code. Most likely "
                 "a wrong Server URL in config ({url})."
                 .format(code=r.status_code, url=CONFIG.get('server_url')))
-        raise
+        r.close()
+        raise APIError(r.status_code, url)
     except Exception as e:
         logger.error("Unhandled Exception while requesting data.")
         logger.exception(e)
         raise
     else:
-        return r.json()
+        return r
+
+
+def wire_bytes(r):
+    """ size of the response body as received, before decompression """
+    tell = getattr(r.raw, 'tell', None)
+    if tell is not None:
+        return tell()
+    return int(r.headers.get('Content-Length') or 0)
+
+
+def get_api_data(url_or_path, **params):
+    r = get_api_response(url_or_path, **params)
+    metrics = get_metrics(r.url)
+    metrics.incr('decoded_bytes', len(r.content))
+    metrics.incr('bytes', wire_bytes(r))
+    started_on = time.time()
+    data = r.json()
+    metrics.incr('decode_time', time.time() - started_on)
+    return data
+
+
+def stream_api_data(url_or_path, **params):
+    """ API page whose `results` are decoded lazily from the response
+
+        keys sent before `results` (count, next...) are set right away,
+        the ones after it once all results have been consumed. """
+    r = get_api_response(url_or_path, stream=True, **params)
+    metrics = get_metrics(r.url)
+
+    def counted(chunks):
+        for chunk in chunks:
+            metrics.incr('decoded_bytes', len(chunk))
+            yield chunk
+
+    def close():
+        metrics.incr('bytes', wire_bytes(r))
+        r.close()
+
+    return JSONPageStream(
+        counted(r.iter_content(chunk_size=STREAM_CHUNK_SIZE)),
+        on_close=close, metrics=metrics).page
 
 
 def post_api_data(url_or_path, payload):
-    headers = {'Authorization': "Token {}".format(CONFIG.get("api_token")),
-               'Content-type': 'application/json'}
-    if url_or_path.startswith('http'):
-        url = url_or_path
-    else:
-        url = "{server}{path}" \
-              .format(server=CONFIG.get('server_url'), path=url_or_path)
+    headers = {'Content-type': 'application/json'}
+    url = api_url(url_or_path)
     logger.debug("URL: {}".format(url))
     try:
-        r = requests.post(url=url, headers=headers,
-                          data=json.dumps(payload), timeout=TIMEOUT)
+        r = api_request('POST', url, idempotent=False, headers=headers,
+                        data=json.dumps(payload))
         assert r.status_code in (200, 201)
     except AssertionError:
         if r.status_code in (403, 401):
@@ -177,6 +449,212 @@ def post_api_data(url_or_path, payload):
         return r.json()
 
 
+class JSONPageStream(object):
+    """ incremental decoder for a JSON object with a `results` list
+
+        only the item being decoded and the current chunk are held
+        in memory instead of the whole body and decoded page. """
+
+    def __init__(self, chunks, on_close=None, results_key='results',
+                 metrics=None):
+        self.chunks = iter(chunks)
+        self.on_close = on_close
+        self.metrics = metrics
+        self.results_key = results_key
+        self.decoder = json.JSONDecoder()
+        self.text = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ""
+        self.pos = 0
+        self.exhausted = False
+        self.decode_time = 0
+        self.page = {}
+        self.read_object()
+
+    def close(self):
+        if self.on_close is not None:
+            self.on_close()
+            self.on_close = None
+            if self.metrics is not None:
+                self.metrics.incr('decode_time', self.decode_time)
+
+    def fill(self):
+        """ appends the next chunk to buffer, False if none left """
+        if self.exhausted:
+            return False
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            self.exhausted = True
+            self.buffer += self.text.decode(b'', final=True)
+            return False
+        self.buffer = self.buffer[self.pos:] + self.text.decode(chunk)
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """ next non-blank char, without consuming it """
+        while True:
+            while self.pos < len(self.buffer) \
+                    and self.buffer[self.pos] in ' \t\n\r':
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                raise ValueError("Unexpected end of JSON stream")
+
+    def expect(self, chars):
+        char = self.peek()
+        if char not in chars:
+            raise ValueError("Expected one of `{}`, got `{}` in JSON stream"
+                             .format(chars, char))
+        self.pos += 1
+        return char
+
+    def value(self):
+        """ decodes next JSON value once fully buffered """
+        self.peek()
+        while True:
+            started_on = time.time()
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                self.decode_time += time.time() - started_on
+                if not self.fill():
+                    raise
+                continue
+            self.decode_time += time.time() - started_on
+            # a number could continue in next chunk
+            if end == len(self.buffer) and self.fill():
+                continue
+            self.pos = end
+            return value
+
+    def read_object(self):
+        """ reads keys up to results, which is left for iter_results """
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            self.close()
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            if key == self.results_key:
+                self.page[key] = StreamedResults(self)
+                return
+            self.page[key] = self.value()
+            if self.expect(',}') == '}':
+                self.close()
+                return
+
+    def read_trailer(self):
+        while self.expect(',}') == ',':
+            key = self.value()
+            self.expect(':')
+            self.page[key] = self.value()
+
+    def iter_results(self):
+        try:
+            self.expect('[')
+            if self.peek() == ']':
+                self.pos += 1
+            else:
+                while True:
+                    yield self.value()
+                    if self.expect(',]') == ']':
+                        break
+            self.read_trailer()
+        finally:
+            self.close()
+
+
+class StreamedResults(object):
+    """ iterator over the results of a JSONPageStream
+
+        closing it releases the response, even if no result was read
+        (closing a generator which has not started runs no cleanup). """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.results = stream.iter_results()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.results)
+
+    next = __next__
+
+    def close(self):
+        self.results.close()
+        self.stream.close()
+
+
+def close_results(page):
+    """ releases the response of a streamed page (no-op otherwise) """
+    results = page.get('results')
+    if hasattr(results, 'close'):
+        results.close()
+
+
+def write_atomic(path, content):
+    """ writes bytes to a temp file next to path then renames it to path
+
+        readers never see a partially written file """
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+    os.rename(tmp_path, path)
+
+
+def json_output_path(folder, name, gzipped=False):
+    return os.path.join(folder, '{}.json{}'.format(
+        name, '.gz' if gzipped else ''))
+
+
+def write_json_output(folder, name, data, pretty=False, gzipped=False):
+    """ writes data to <name>.json (or <name>.json.gz) in folder
+
+        the file is left untouched if it already holds the very same
+        content (gzip mtime is zeroed so compression is deterministic).
+        returns whether the file was written """
+    content = json.dumps(data, default=jsdthandler,
+                         indent=4 if pretty else None,
+                         separators=None if pretty else (',', ':')) \
+        .encode('utf-8')
+    if gzipped:
+        buffer = io.BytesIO()
+        with gzip.GzipFile(filename='', mode='wb', fileobj=buffer,
+                           mtime=0) as f:
+            f.write(content)
+        content = buffer.getvalue()
+
+    path = json_output_path(folder, name, gzipped)
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            if f.read() == content:
+                logger.debug("{} is unchanged".format(path))
+                return False
+    write_atomic(path, content)
+
+    # the other encoding would be stale
+    other_path = json_output_path(folder, name, not gzipped)
+    if os.path.exists(other_path):
+        os.remove(other_path)
+    return True
+
+
+def read_json_output(folder, name):
+    """ data of <name>.json or <name>.json.gz in folder """
+    path = json_output_path(folder, name, gzipped=True)
+    if os.path.exists(path):
+        with gzip.open(path, 'rb') as f:
+            return json.loads(f.read().decode('utf-8'))
+    with open(json_output_path(folder, name), 'r') as f:
+        return json.load(f)
+
+
 def import_path(name, failsafe=False):
     """ import a callable from full module.callable name """
     def _imp(name):
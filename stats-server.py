@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+import datetime
+import gzip
+import hashlib
+import io
+import json
+import threading
+from collections import OrderedDict
+
+import cherrypy
+from docopt import docopt
+
+from rapidpro_tools import logger, change_logging_level
+from rapidpro_tools.utils import (end_of_day, period_middle, js_timestamp,
+                                  jsdthandler, namesort)
+from rapidpro_tools.mongo import meta, rollups
+from export_message_stats import (get_periods, get_relayers,
+                                  get_rollup_counts, period_stats,
+                                  ROLLUPS_META)
+
+help = ("""Usage: stats-server.py [-v] [-h] [-p port] [-c size]
+
+-h --help                       Display this help message
+-v --verbose                    Display DEBUG messages
+-p --port=<port>                Port to listen on (defaults to 8080)
+-c --cache-size=<nb_responses>  Nb of responses kept in cache"""
+        """ (defaults to 128)
+
+This script serves message statistics for any date range from the """
+        """daily rollups of export_message_stats.py.
+GET /stats?start=YYYY-MM-DD&end=YYYY-MM-DD&granularity=day|month|total"""
+        """&relayers=417,485 """)
+
+GRANULARITIES = ('day', 'month', 'total')
+
+
+class LRUCache(object):
+    """ thread-safe mapping keeping the max_size most recently used keys """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                return None
+            self.entries[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+def parse_day(value, name):
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise cherrypy.HTTPError(
+            400, "`{}` must be YYYY-MM-DD formatted".format(name))
+
+
+def rollups_bounds():
+    """ first and last day of the daily rollups """
+    days = [rollup['day'] for order in (1, -1)
+            for rollup in rollups.find({}, {'day': True})
+            .sort([('day', order)]).limit(1)]
+    if not days:
+        raise cherrypy.HTTPError(503, "No daily rollups. Run an export.")
+    return [datetime.datetime.strptime(day, '%Y-%m-%d') for day in days]
+
+
+def compute_stats(start_on, end_on, granularity, relayer_ids):
+    """ period stats of the range, as in the exported JSON files """
+    counts = get_rollup_counts(start_on, end_on)
+    if granularity == 'total':
+        period = {'name': "TOTAL", 'start_on': start_on, 'end_on': end_on}
+        period['middle'] = period_middle(start_on, end_on)
+        period['middle_ts'] = js_timestamp(period['middle'])
+        return period_stats(period, counts, relayer_ids)
+
+    periods = get_periods(start_on=start_on, end_on=end_on)
+    return OrderedDict([
+        (period['name'], period_stats(period, counts, relayer_ids))
+        for period in sorted(periods['{}s'.format(granularity)].values(),
+                             key=namesort)])
+
+
+class StatsServer(object):
+
+    def __init__(self, cache_size=128):
+        self.cache = LRUCache(cache_size)
+
+    @cherrypy.expose
+    def stats(self, start=None, end=None, granularity='day', relayers=None):
+        if granularity not in GRANULARITIES:
+            raise cherrypy.HTTPError(
+                400, "`granularity` must be one of {}"
+                .format(", ".join(GRANULARITIES)))
+        # a repeated parameter comes as a list
+        if isinstance(relayers, list):
+            relayers = ','.join(relayers)
+        try:
+            relayer_ids = sorted([int(relayer_id)
+                                  for relayer_id in relayers.split(',')]) \
+                if relayers else None
+        except (ValueError, AttributeError):
+            raise cherrypy.HTTPError(400, "`relayers` must be relayer ids")
+
+        # rollups are refreshed by each export
+        version = (meta.find_one({'endpoint': ROLLUPS_META}) or {}) \
+            .get('updated_on')
+        key = (version, start, end, granularity,
+               tuple(relayer_ids) if relayer_ids else None)
+        response = self.cache.get(key)
+        if response is None:
+            logger.debug("Computing stats for {}".format(key))
+            start_on, end_on = rollups_bounds() \
+                if not (start and end) else (None, None)
+            if start:
+                start_on = parse_day(start, 'start')
+            if end:
+                end_on = parse_day(end, 'end')
+            end_on = end_of_day(end_on.year, end_on.month, end_on.day)
+            if relayer_ids is None:
+                relayer_ids = [r['relayer'] for r in get_relayers()]
+
+            body = json.dumps(
+                compute_stats(start_on, end_on, granularity, relayer_ids),
+                default=jsdthandler, separators=(',', ':')).encode('utf-8')
+            buffer = io.BytesIO()
+            with gzip.GzipFile(filename='', mode='wb', fileobj=buffer,
+                               mtime=0) as f:
+                f.write(body)
+            response = {
+                'etag': '"{}"'.format(hashlib.sha1(body).hexdigest()),
+                'body': body,
+                'gzipped': buffer.getvalue(),
+            }
+            self.cache.set(key, response)
+
+        headers = cherrypy.response.headers
+        headers['Content-Type'] = 'application/json'
+        headers['ETag'] = response['etag']
+        headers['Vary'] = 'Accept-Encoding'
+        if_none_match = cherrypy.request.headers.get('If-None-Match', '')
+        if response['etag'] in [etag.strip()
+                                for etag in if_none_match.split(',')]:
+            cherrypy.response.status = 304
+            return b''
+        if 'gzip' in cherrypy.request.headers.get('Accept-Encoding', ''):
+            headers['Content-Encoding'] = 'gzip'
+            return response['gzipped']
+        return response['body']
+
+
+def main(arguments):
+    debug = arguments.get('--verbose') or False
+    change_logging_level(debug)
+
+    port = int(arguments.get('--port') or 8080)
+    logger.info("Serving message statistics on "
+                "http://127.0.0.1:{}/stats".format(port))
+
+    cherrypy.config.update({
+        'server.socket_port': port,
+        'engine.autoreload.on': False,
+        'log.screen': debug,
+    })
+    cherrypy.quickstart(StatsServer(
+        cache_size=int(arguments.get('--cache-size') or 128)), '/')
+
+
+if __name__ == '__main__':
+    main(docopt(help, version=0.1))